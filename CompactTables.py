@@ -0,0 +1,233 @@
+"""
+CompactTables.py
+Read-only rule tables for Volume2 kept in flat buffers instead of dicts.
+Should contain:
+    Lexicon, the MainDictionary word list with each word's English flag
+    StringSet, StringMap and PairMap, for personal names and the rule files
+Notes:
+    A dict of a few hundred thousand short strings costs tens of MB in every
+    process, and because reading it touches reference counts, forked workers
+    end up with private copies of it as well. These tables keep their keys in
+    one UTF-8 blob and find them through an open-addressed hash table, so a
+    whole table is a few flat arrays. Written to a file and opened with mmap,
+    every process on a node reads the same page-cache copy; built in memory,
+    it is a single bytes object that forked workers never write to.
+    Layout (native byte order, 4-byte unsigned ints):
+        header      magic, number of slots, number of keys, key blob length
+        slots       1 + the number of the key in each hash slot, 0 if empty
+        offsets     where each key starts in the blob, plus where the last ends
+        key blob    the keys, UTF-8 encoded, back to back, padded to 4 bytes
+        values      Lexicon: one flag byte per key
+                    StringMap: value offsets and value blob, laid out like the keys
+    Slots are picked with crc32 rather than hash(), which is salted per process.
+"""
+import mmap
+import os
+import struct
+from array import array
+from zlib import crc32
+
+HEADER = struct.Struct("=4sIII")
+
+def encode(string):
+    return string.encode("utf-8", "surrogatepass")
+
+def pack_strings(strings):
+    """
+    Returns: array of offsets and bytes blob for the encoded strings, back to back
+    """
+    offsets = array("I", [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string
+        offsets.append(len(blob))
+    return offsets, bytes(blob) + bytes(-len(blob) % 4)
+
+def build_table(magic, keys, values=b""):
+    """
+    Args:
+        magic (bytes): 4 bytes naming the kind of table
+        keys (list): encoded keys, numbered in this order
+        values (bytes): whatever the kind of table stores per key
+
+    Returns: the bytes of the table
+    """
+    nslots = 8
+    while nslots < 2 * len(keys):
+        nslots *= 2
+    mask = nslots - 1
+    slots = array("I", bytes(4 * nslots))
+    for number, key in enumerate(keys):
+        slot = crc32(key) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = number + 1
+    offsets, blob = pack_strings(keys)
+    header = HEADER.pack(magic, nslots, len(keys), offsets[-1])
+    return header + slots.tobytes() + offsets.tobytes() + blob + values
+
+class StringSet(object):
+
+    """Read-only set of strings, answering like the set it was built from."""
+
+    MAGIC = b"SET1"
+
+    def __init__(self, buffer):
+        """
+        Args:
+            buffer: bytes or mmap holding a table from build
+        """
+        magic, nslots, nkeys, bloblen = HEADER.unpack_from(buffer, 0)
+        if magic != self.MAGIC:
+            raise ValueError("not a %s table" % type(self).__name__)
+        view = memoryview(buffer)
+        start = HEADER.size
+        self.mask = nslots - 1
+        self.slots = view[start:start + 4 * nslots].cast("I")
+        start += 4 * nslots
+        self.offsets = view[start:start + 4 * (nkeys + 1)].cast("I")
+        start += 4 * (nkeys + 1)
+        self.blob_start = start
+        self.values_start = start + bloblen + (-bloblen % 4)
+        self.buffer = buffer
+        self.view = view
+        self.nkeys = nkeys
+
+    @classmethod
+    def build(cls, table):
+        return build_table(cls.MAGIC, sorted(encode(key) for key in table))
+
+    @classmethod
+    def from_table(cls, table):
+        return cls(cls.build(table))
+
+    @classmethod
+    def save(cls, table, filepath):
+        """Writes table in this form to filepath, atomically."""
+        tmp_path = filepath + ".tmp%d" % os.getpid()
+        with open(tmp_path, "wb") as fout:
+            fout.write(cls.build(table))
+        os.replace(tmp_path, filepath)
+
+    @classmethod
+    def open(cls, filepath):
+        """Maps a file written by save; processes opening the same file share its pages."""
+        with open(filepath, "rb") as fin:
+            buffer = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer)
+
+    def find(self, key):
+        """
+        Returns: the key's number in the table, or -1 if it isn't there
+        """
+        key = encode(key)
+        mask = self.mask
+        slots = self.slots
+        offsets = self.offsets
+        buffer = self.buffer
+        base = self.blob_start
+        slot = crc32(key) & mask
+        number = slots[slot]
+        while number:
+            number -= 1
+            if buffer[base + offsets[number]:base + offsets[number + 1]] == key:
+                return number
+            slot = (slot + 1) & mask
+            number = slots[slot]
+        return -1
+
+    def key(self, number):
+        start = self.blob_start + self.offsets[number]
+        end = self.blob_start + self.offsets[number + 1]
+        return self.buffer[start:end].decode("utf-8", "surrogatepass")
+
+    def __len__(self):
+        return self.nkeys
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __iter__(self):
+        for number in range(self.nkeys):
+            yield self.key(number)
+
+class Lexicon(StringSet):
+
+    """Read-only mapping of word -> English flag (0-255), answering like the dict it was built from."""
+
+    MAGIC = b"LEX2"
+
+    def __init__(self, buffer):
+        StringSet.__init__(self, buffer)
+        self.flags = self.view[self.values_start:self.values_start + self.nkeys]
+
+    @classmethod
+    def build(cls, table):
+        items = sorted((encode(word), flag) for word, flag in table.items())
+        flags = bytes(flag for word, flag in items) # ValueError for flags that don't fit in a byte
+        return build_table(cls.MAGIC, [word for word, flag in items], flags)
+
+    def __getitem__(self, word):
+        number = self.find(word)
+        if number < 0:
+            raise KeyError(word)
+        return self.flags[number]
+
+    def get(self, word, default=None):
+        number = self.find(word)
+        if number < 0:
+            return default
+        return self.flags[number]
+
+class StringMap(StringSet):
+
+    """Read-only mapping of string -> string, answering like the dict it was built from."""
+
+    MAGIC = b"MAP1"
+
+    def __init__(self, buffer):
+        StringSet.__init__(self, buffer)
+        start = self.values_start
+        self.value_offsets = self.view[start:start + 4 * (self.nkeys + 1)].cast("I")
+        self.value_start = start + 4 * (self.nkeys + 1)
+
+    @classmethod
+    def build(cls, table):
+        items = sorted((encode(key), encode(value)) for key, value in table.items())
+        value_offsets, value_blob = pack_strings(value for key, value in items)
+        return build_table(cls.MAGIC, [key for key, value in items], value_offsets.tobytes() + value_blob)
+
+    def value(self, number):
+        start = self.value_start + self.value_offsets[number]
+        end = self.value_start + self.value_offsets[number + 1]
+        return self.buffer[start:end].decode("utf-8", "surrogatepass")
+
+    def __getitem__(self, key):
+        number = self.find(key)
+        if number < 0:
+            raise KeyError(key)
+        return self.value(number)
+
+    def get(self, key, default=None):
+        number = self.find(key)
+        if number < 0:
+            return default
+        return self.value(number)
+
+class PairMap(StringMap):
+
+    """StringMap keyed on tuples of strings, like the fuse rules."""
+
+    SEPARATOR = "\x00"
+
+    @classmethod
+    def build(cls, table):
+        return StringMap.build(dict((cls.SEPARATOR.join(key), value) for key, value in table.items()))
+
+    def find(self, key):
+        if not isinstance(key, tuple):
+            return -1
+        return StringMap.find(self, self.SEPARATOR.join(key))
+
+    def key(self, number):
+        return tuple(StringMap.key(self, number).split(self.SEPARATOR))
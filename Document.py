@@ -15,10 +15,8 @@ Should have methods to:
     remove_headers
     remove_footers
 """
-from difflib import SequenceMatcher
 import glob
 import re
-import sys
 import signal
 import shutil
 import os
@@ -26,23 +24,424 @@ from os import path
 import datetime
 import subprocess
 import codecs
+import json
+import time
+import argparse
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from collections import deque
+from bisect import bisect_left
 from Page import Page
+from OCRCache import OCRCache
+import TesseractAPI
+import PageTriage
+from Similarity import FastEngine, PhraseIndex
 import Volume2
 
-def call(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300):
+def page_ranges(pages, chunk=None):
+    """
+    Collapse a sorted list of page numbers into (first, last) runs, e.g.
+    [1, 2, 3, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)]
+    No run is longer than chunk pages, if given.
+    """
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1 and not (chunk and page - ranges[-1][0] >= chunk):
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+class ChildProcesses(object):
+    """
+    The gs and tesseract processes a document has running, each in a process
+    group of its own, so that a document that is given up on (see
+    process_document's timeout) takes them down with it rather than leaving
+    them to run on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.killed = False
+
+    def popen(self, cmd, **kwargs):
+        """
+        subprocess.Popen for a shell command, in a new process group.
+        Raises ChildProcessError once kill() has been called.
+        """
+        with self.lock:
+            if self.killed:
+                raise ChildProcessError("not starting '%s': the document was abandoned" % cmd)
+            proc = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid, **kwargs)
+            self.running.add(proc)
+        return proc
+
+    def finished(self, proc):
+        with self.lock:
+            self.running.discard(proc)
+
+    def kill(self):
+        """
+        Kill every process still running, and refuse to start any more.
+        """
+        with self.lock:
+            self.killed = True
+            for proc in self.running:
+                kill_group(proc)
+
+def kill_group(proc):
+    """
+    SIGTERM the process group of a process started by ChildProcesses.popen.
+    """
+    try:
+        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+    except OSError:
+        pass # already gone
+
+def call(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300, input=None, children=None):
     """
     timeout-enable popen with stdout/stderr propagation
+    input (bytes), if given, is written to the process's stdin
+    children (ChildProcesses), if given, tracks the process while it runs
     """
-    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, shell=True, preexec_fn=os.setsid)
+    if children is None:
+        children = ChildProcesses()
+    stdin = subprocess.PIPE if input is not None else None
+    proc = children.popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
     try:
-        outs, errs = proc.communicate(timeout=timeout)
+        outs, errs = proc.communicate(input=input, timeout=timeout)
         print("OK", str(outs), str(errs), "finished at %s" % datetime.datetime.now())
-        return 0, outs, errs
+        return proc.returncode, outs, errs
     except subprocess.TimeoutExpired:
         print("Process timed out at %s! cmd:" % datetime.datetime.now())
         print("\t%s" % cmd)
-        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+        kill_group(proc)
         return 1, None, None
+    finally:
+        children.finished(proc)
+
+class TokenWriter(object):
+    """
+    Writes corrected tokens out as text, spacing them the way the clean
+    output always has: a space after every word, none after linebreaks,
+    markup or opening quotes, and none before a quote that starts a line.
+    Formatted tokens are joined into chunks before they reach the file, so
+    long documents don't cost a write call per token.
+    """
+
+    def __init__(self, filepath, lasttoken="", chunk_tokens=8192):
+        self.fout = codecs.open(filepath, "w", "utf-8")
+        self.lasttoken = lasttoken
+        self.chunk_tokens = chunk_tokens
+        self.buffer = []
+
+    def write(self, tokens):
+        lasttoken = self.lasttoken
+        buffer = self.buffer
+        for token in tokens:
+            if lasttoken == '\n' and (token == '"' or token == "'"):
+                pass
+            elif token != '\n' and token != "“" and not (token.startswith('<') and token.endswith('>')):
+                token = token + " "
+            buffer.append(token)
+            lasttoken = token
+            if len(buffer) >= self.chunk_tokens:
+                self.flush()
+        self.lasttoken = lasttoken
+
+    def flush(self):
+        self.fout.write("".join(self.buffer))
+        del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RenderProfile(object):
+    """
+    How pages get rasterized for tesseract: resolution, Ghostscript output
+    device, and whether the raster is written to ocr_tmp/ or piped straight
+    into tesseract's stdin. Piping needs one of the binary PNM devices, since
+    that is the only multi-page stream we can split back into pages.
+
+    The defaults reproduce the original 600 dpi png16m-on-disk behaviour.
+    """
+
+    DEVICES = {"png16m" : "png", "pnggray" : "png", "pngmono" : "png",
+               "ppmraw" : "ppm", "pgmraw" : "pgm", "pbmraw" : "pbm"}
+    PIPE_DEVICES = ("ppmraw", "pgmraw", "pbmraw")
+    MONO_DEVICES = ("pngmono", "pbmraw")
+
+    def __init__(self, dpi=600, device="png16m", pipe=False):
+        if device not in self.DEVICES:
+            raise ValueError("Unknown render device %s! Choose one of (%s)" % (device, sorted(self.DEVICES)))
+        if pipe and device not in self.PIPE_DEVICES:
+            raise ValueError("Piping pages to tesseract needs one of (%s), not %s" % (self.PIPE_DEVICES, device))
+        self.dpi = dpi
+        self.device = device
+        self.pipe = pipe
+
+    def gs_args(self):
+        """
+        Returns: Ghostscript device/resolution arguments for this profile
+        """
+        args = "-sDEVICE=%s -r%d" % (self.device, self.dpi)
+        if self.device not in self.MONO_DEVICES:
+            # anti-aliasing means nothing on a 1-bit device
+            args += " -dGraphicsAlphaBits=4 -dTextAlphaBits=4"
+        return args
+
+    def extension(self):
+        return self.DEVICES[self.device]
+
+    def cache_key(self):
+        """
+        Returns: the part of the profile that changes what tesseract sees (piping doesn't)
+        """
+        return "%s-%d" % (self.device, self.dpi)
+
+    def __repr__(self):
+        return "RenderProfile(dpi=%d, device=%s, pipe=%s)" % (self.dpi, self.device, self.pipe)
+
+RENDER_PROFILES = {
+    "default" : RenderProfile(),
+    "gray300" : RenderProfile(dpi=300, device="pnggray"),
+    "gray300-pipe" : RenderProfile(dpi=300, device="pgmraw", pipe=True),
+    "mono300-pipe" : RenderProfile(dpi=300, device="pbmraw", pipe=True),
+}
+
+# how pages are rendered for PageTriage.triage_page
+TRIAGE_PROFILE = RenderProfile(dpi=PageTriage.TRIAGE_DPI, device="pgmraw", pipe=True)
+
+class SubprocessEngine(object):
+    """
+    Runs the tesseract binary once per page. Always available, and what
+    the other engines fall back on.
+    """
+
+    def __init__(self, tesseract_args, single_threaded=False, children=None):
+        """
+        Args:
+            tesseract_args (str): options for the tesseract command line
+            single_threaded (bool): keep tesseract to one OpenMP thread
+            children (ChildProcesses): where to track running tesseracts
+        """
+        self.tesseract_args = tesseract_args
+        self.single_threaded = single_threaded
+        self.children = children
+
+    def recognize(self, image, out_base):
+        """
+        OCR one page, writing out_base.txt and out_base.hocr.
+
+        Args:
+            image (str or bytes): path to the rendered page, or the raster
+                itself, which is piped to tesseract over stdin
+            out_base (str): output path minus extension
+
+        Returns: tesseract's exit status
+        """
+        # tesseract spins up its own OpenMP threads; when several pages are in
+        # flight at once they just fight each other for the same cores.
+        env = "OMP_THREAD_LIMIT=1 " if self.single_threaded else ""
+        if isinstance(image, bytes):
+            source, data = "stdin", image
+        else:
+            source, data = image, None
+        cmd = "%(env)stesseract %(image)s %(out)s %(args)s txt hocr" % {"env" : env, "image" : source, "out" : out_base, "args" : self.tesseract_args}
+        status, _, _ = call(cmd, input=data, children=self.children)
+        return status
+
+OCR_ENGINES = ("auto", "api", "subprocess")
+
+def make_engine(name, tesseract_args, single_threaded=False, children=None):
+    """
+    Args:
+        name (str): "api" for tesseract in-process (see TesseractAPI.py),
+            "subprocess" for the binary, "auto" for the API when it's there
+        tesseract_args (str): options, in command line form
+        single_threaded (bool): keep tesseract to one OpenMP thread
+        children (ChildProcesses): where the binary's runs are tracked
+
+    Returns: an engine with recognize(image, out_base)
+    """
+    if name != "subprocess":
+        engine = TesseractAPI.get_engine(tesseract_args, single_threaded)
+        if engine is not None:
+            return engine
+        if name == "api":
+            print("ERROR\tCan't run tesseract in-process with '%s'; using the tesseract binary" % tesseract_args)
+    return SubprocessEngine(tesseract_args, single_threaded, children)
+
+def ocr_tiers(tesseract_args):
+    """
+    Returns: the tesseract argument strings to try on a page, in turn.
+    Combined legacy + LSTM recognition (--oem 2) is tesseract's slowest mode,
+    so LSTM alone (--oem 1) goes first and only pages that come out of it
+    badly are run again with the combined mode.
+    """
+    combined = re.compile(r"--oem\s+2\b")
+    if combined.search(tesseract_args) is None:
+        return [tesseract_args]
+    return [combined.sub("--oem 1", tesseract_args), tesseract_args]
+
+def hocr_confidence(hocr_path):
+    """
+    Returns: mean word confidence (x_wconf, 0-100) in a tesseract hOCR file,
+    or None if it has no words or can't be read
+    """
+    try:
+        with codecs.open(hocr_path, "r", "utf-8", errors="replace") as fin:
+            confidences = [int(conf) for conf in re.findall(r"x_wconf (\d+)", fin.read())]
+    except IOError:
+        return None
+    if not confidences:
+        return None
+    return float(sum(confidences)) / len(confidences)
+
+## A page's embedded text is used instead of OCR when it has at least
+## TEXT_LAYER_MIN_WORDS words, at least TEXT_LAYER_FOUND of them in the
+## lexicon and TEXT_LAYER_ENGLISH of them English (Volume2.as_stream's
+## percentfound and percentenglish).
+TEXT_LAYER_MIN_WORDS = 20
+TEXT_LAYER_FOUND = 0.8
+TEXT_LAYER_ENGLISH = 0.6
+
+def text_layer_usable(lines):
+    """
+    Whether a page's embedded text is good enough to skip OCR. Scanned pages
+    have no text layer or a junk one, and some born-digital PDFs use fonts
+    whose text extracts as gibberish; neither reads as lexicon words.
+
+    Args:
+        lines (list): the page's text, one line per item
+
+    Returns: bool
+    """
+    tokens, percentfound, percentenglish = Volume2.as_stream(lines)
+    return (Volume2.count_words(tokens) >= TEXT_LAYER_MIN_WORDS
+            and percentfound >= TEXT_LAYER_FOUND and percentenglish >= TEXT_LAYER_ENGLISH)
+
+def infer_pagenumbers(potential_pagenumbers, found_pagenumbers, cutoff=0.7):
+    """
+    Keep the candidate page numbers that fit a consistent numbering of the
+    whole document.
+
+    A candidate pageno on page i implies the document is numbered from
+    offset = pageno - i, and it is kept if more than cutoff of the numbers
+    offset .. offset + len(pages) - 1 were seen somewhere in the document.
+    That only depends on the offset, so each distinct offset is scored once,
+    with two bisects into the sorted observed numbers, and the pages that
+    accept a number vote for its offset.
+
+    Args:
+        potential_pagenumbers (list): per page, the numbers found near its top/bottom
+        found_pagenumbers (list): per page, updated in place with the accepted number
+
+    Returns: (offset with the most votes, fraction of pages voting for it),
+    or (None, 0.0) if no number was accepted
+
+    """
+    n_pages = len(potential_pagenumbers)
+    observed = sorted(set(y for x in potential_pagenumbers for y in x))
+    support = dict()
+    voters = dict()
+    for i, page in enumerate(potential_pagenumbers):
+        for pageno in page:
+            offset = pageno - i
+            if offset not in support:
+                support[offset] = bisect_left(observed, offset + n_pages) - bisect_left(observed, offset)
+            if float(support[offset])/n_pages > cutoff:
+                found_pagenumbers[i] = pageno
+                voters.setdefault(offset, set()).add(i)
+    if not voters:
+        return None, 0.0
+    # ties go to the offset explaining more of the observed numbers, then the smaller one
+    offset = max(voters, key=lambda o: (len(voters[o]), support[o], -o))
+    return offset, float(len(voters[offset]))/n_pages
+
+class HeaderDetector(object):
+    """
+    Document.find_headers, fed one page at a time. Each page's candidate
+    lines (Page.get_firsttwo) are compared with those of the two pages
+    before it as soon as it is added, so only a three-page window of
+    candidate lines is ever kept, plus the small per-page sets of repeats
+    and the candidate page numbers (which need the whole document).
+
+    Repeats found so far are in self.phrases as pages are added. finish()
+    hands everything to the Document.
+    """
+
+    WINDOW = 3
+
+    def __init__(self, similarity, modes=(True, False)):
+        """
+        Args:
+            similarity: engine from Similarity.py
+            modes (tuple): footer_mode values to look at, in the order their
+                page numbers are applied (footer first, like main() always did)
+        """
+        self.similarity = similarity
+        self.modes = modes
+        self.windows = dict((mode, deque(maxlen=self.WINDOW)) for mode in modes)
+        self.potential_pagenumbers = dict((mode, list()) for mode in modes)
+        self.repeated = list()
+        self.phrases = set()
+
+    def __len__(self):
+        return len(self.repeated)
+
+    def add(self, page):
+        index = len(self.repeated)
+        self.repeated.append(set())
+        for mode in self.modes:
+            thesetwo, thesepagenos = page.get_firsttwo(mode)
+            self.potential_pagenumbers[mode].append(thesepagenos)
+            window = self.windows[mode]
+            window.append(thesetwo)
+            # identify lines that repeat within "this page and the two previous
+            # pages"; like the original loop, this starts at the third page,
+            # so the first two pages are never compared with each other
+            if len(window) < self.WINDOW:
+                continue
+            for offset, previouslines in enumerate(list(window)[:-1]):
+                j = index - self.WINDOW + 1 + offset
+                for lineA in thesetwo:
+                    for lineB in previouslines:
+                        # The zero indexes below are just selecting the string part
+                        # of a string, index tuple.
+                        if self.similarity.similar(lineA[0], lineB[0], .8):
+                            self.repeated[index].add(lineA)
+                            self.repeated[j].add(lineB) #TODO Hmm... why isn't this catching the author's name on page 2 (index 1)?
+                            self.phrases.add(lineA[0])
+                            self.phrases.add(lineB[0])
+
+    def finish(self, document):
+        """
+        Copy the repeats and page numbers into the document's repeated,
+        repeated_phrases and found_pagenumbers.
+        """
+        # For very short documents, this is not a meaningful task.
+        if len(self.repeated) < 5:
+            return
+        for index, found in enumerate(self.repeated):
+            document.repeated[index] |= found
+        document.repeated_phrases |= self.phrases
+        for mode in self.modes:
+            offset, confidence = infer_pagenumbers(self.potential_pagenumbers[mode], document.found_pagenumbers)
+            if offset is not None and confidence > document.pagenumber_confidence:
+                document.pagenumber_offset = offset
+                document.pagenumber_confidence = confidence
 
 class Document(object):
     """
@@ -58,24 +457,77 @@ class Document(object):
         for key, val in kwargs.items():
             setattr(self, key, val)
 
-        if self.pdf_path is not None:
-            _, out, _ = call("gs -q -dNODISPLAY -c \"(%s) (r) file runpdfbegin pdfpagecount = quit\"" % self.pdf_path)
-            try:
-                self.number_of_pages = int(out)
-            except ValueError as e:
-                print("ERROR\t Could not get number of pages. Possible document is not a PDF! Error: %s" % e)
+        # filled in by rasterize() from Ghostscript's own page count, so the
+        # PDF is only parsed once
+        self.number_of_pages = None
 
+        if not hasattr(self, "working_dir"):
+            self.working_dir = "./"
+
+        # number of pages OCRed concurrently by ocr()
+        if not hasattr(self, "ocr_workers"):
+            self.ocr_workers = os.cpu_count() or 1
+        # optional semaphore limiting tesseract runs across several documents
+        if not hasattr(self, "ocr_slots"):
+            self.ocr_slots = None
+        # pages per Ghostscript call; None renders the whole document at once
+        if not hasattr(self, "render_chunk"):
+            self.render_chunk = None
+        if not hasattr(self, "render_profile"):
+            self.render_profile = RENDER_PROFILES["default"]
+        if not hasattr(self, "tesseract_args"):
+            self.tesseract_args = "-l eng --psm 1 --oem 2"
+        # one of OCR_ENGINES; ocr() builds the engines itself (see make_engine)
+        if not hasattr(self, "ocr_engine"):
+            self.ocr_engine = "auto"
+        # OCR with LSTM only first, and again with tesseract_args for pages
+        # whose mean word confidence is below retry_confidence (see ocr_tiers)
+        if not hasattr(self, "adaptive_oem"):
+            self.adaptive_oem = True
+        if not hasattr(self, "retry_confidence"):
+            self.retry_confidence = 70
+        self.engines = None
+        self.tier_stats = []
+        # gs and tesseract processes running for this document (see abandon)
+        self.children = ChildProcesses()
+        # sort pages with PageTriage first: blank pages aren't OCRed, and
+        # image-only pages only get the first tier
+        if not hasattr(self, "triage_pages"):
+            self.triage_pages = PageTriage.numpy is not None
+        self.blank_pages = set()
+        self.image_pages = set()
+        self.stats_lock = threading.Lock()
+        # take pages from the PDF's own text layer when it's good enough
+        # (see extract_text_layer); needs Volume2.importrules to have run
+        if not hasattr(self, "use_text_layer"):
+            self.use_text_layer = True
+        self.text_layer_pages = set()
+        # persistent OCR cache shared by all documents; None turns it off
+        if not hasattr(self, "cache_dir"):
+            self.cache_dir = "/output/ocr_cache"
+        self.ocr_cache = None
+        self.failed_pages = {}
+        # set when a gs render exits with an error, so its page count isn't trusted
+        self.render_failed = False
+
+        self.repeated_phrases = set()
+        # pick header/footer candidates by their place on the page in the
+        # hOCR output rather than by line count (see Page.read_bands). Off
+        # by default: it also skips the isolated mid-page line check, so the
+        # cleaned text differs from the line-count mode
+        if not hasattr(self, "header_geometry"):
+            self.header_geometry = False
+        # fuzzy matcher for header/footer lines; any engine from Similarity.py
+        if not hasattr(self, "similarity"):
+            self.similarity = FastEngine()
+        self.phrase_index = None
+
+        # after the defaults above, which the pages read
         if self.page_files is not None:
             self.prep_pagefiles()
         else:
             self.page_files = []
 
-        self.expected_page_numbers = [None]*len(self.page_files)
-
-        if not hasattr(self, "working_dir"):
-            self.working_dir = "./"
-
-        self.repeated_phrases = set()
         if not self.working_dir.endswith("/"):
             self.working_dir += "/"
 
@@ -93,6 +545,15 @@ class Document(object):
             print("ERROR\tCould not create ocr_tmp folder")
             raise ex
 
+    @property
+    def text(self):
+        """
+        The cleaned document text, read from document_clean.txt on demand
+        rather than kept around in memory.
+        """
+        with codecs.open(self.working_dir + "ocr/document_clean.txt", "r", "utf-8") as fin:
+            return fin.read()
+
     def __del__(self):
         # cleanup, etc
         shutil.rmtree(self.working_dir + 'ocr_tmp', True)
@@ -105,11 +566,15 @@ class Document(object):
                 key=lambda s: [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', s)])
         self.repeated = list()
         self.found_pagenumbers = list()
+        self.expected_pagenumbers = [None]*len(self.page_files)
+        # page number of page_list[0], by vote of the pages (see infer_pagenumbers)
+        self.pagenumber_offset = None
+        self.pagenumber_confidence = 0.0
         self.page_list = []
         for i, page_filepath in enumerate(self.page_files):
             self.repeated.append(set())
             self.found_pagenumbers.append(None)
-            self.page_list.append(Page(page_filepath, self, i))
+            self.page_list.append(Page(page_filepath, self, i, geometry=self.header_geometry))
 
     def find_headers(self, footer_mode=False):
         '''
@@ -140,89 +605,59 @@ class Document(object):
         # could change!
         '''
 
-        # For very short documents, this is not a meaningful task.
-        if len(self.page_list) < 5:
-            return
-
-        firsttwos = list()
-        potential_pagenumbers = list()
-        # We construct a list of the first two substantial lines on
-        # each page. We ignore short lines and lines that are just numbers,
-        # and don't go deeper than five lines in any event.
-
-        # We transform lines in this process -- e.g, by removing digits.
-        # We also package them as tuples in order to preserve information
-        # that will allow us to delete the lines identified as repeats.
-
-        SIMILARITY_CUTOFF = 0.7
+        # The work itself is done by HeaderDetector, one page at a time;
+        # detect_headers does both modes in a single pass.
+        detector = HeaderDetector(self.similarity, modes=(footer_mode,))
         for page in self.page_list:
-            thesetwo, thesepagenos = page.get_firsttwo(footer_mode)
-            firsttwos.append(thesetwo)
-            potential_pagenumbers.append(thesepagenos)
-
-        # Now our task is to iterate through the firsttwos, identifying lines that
-        # repeat within a window, which we define as "this page and the two previous
-        # pages."
-
-        # We're going to do this with a list of sets. That way we can add things
-        # without risk of duplication. Otherwise, when we add headers to previous
-        # pages, we're always going to be checking whether they were already added.
-
-        for index in range(2, len(firsttwos)):
-            # We can be sure the 2 index is legal because we have previously filtered
-            # short documents.
+            detector.add(page)
+        detector.finish(self)
 
-            indexedlines = firsttwos[index]
-
-            for j in range(index - 2, index):
-
-                previouslines = firsttwos[j]
-
-                for lineA in indexedlines:
-                    for lineB in previouslines:
-                        s = SequenceMatcher(None, lineA[0], lineB[0])
-                        # The zero indexes above are just selecting the string part
-                        # of a string, index tuple.
+    def detect_headers(self):
+        """
+        find_headers(footer_mode=True) followed by find_headers(footer_mode=False),
+        with the same results, in one pass over the pages: get_firsttwo is
+        called once per page and mode, and each page is compared with the two
+        before it as it arrives.
 
-                        similarity = s.ratio()
-                        if similarity > .8:
-                            self.repeated[index].add(lineA)
-                            self.repeated[j].add(lineB) #TODO Hmm... why isn't this catching the author's name on page 2 (index 1)?
-                            self.repeated_phrases.add(lineA[0])
-                            self.repeated_phrases.add(lineB[0])
-
-        # Now we have a list of sets that contain tuples
-        # representing headers, in original page order, with empty sets where no headers
-        # were found. We can now use the line indexes in the tuples to pop out the
-        # relevant lines.
-
-        #cleanup potential page numbers
-        # for each potential page number, build the 'expected' list based on the doc's len(pages)
-        # compare the expected list to observed and keep any potential number with significant overlap
-        observed = set(y for x in potential_pagenumbers for y in x)
-        for i, page in enumerate(potential_pagenumbers):
-            for pageno in page:
-                expected = set(range(pageno - i, pageno - i + len(potential_pagenumbers)))
-                if float(len(expected.intersection(observed)))/len(potential_pagenumbers) > SIMILARITY_CUTOFF:
-                    self.found_pagenumbers[i] = pageno
+        """
+        detector = HeaderDetector(self.similarity, modes=(True, False))
+        for page in self.page_list:
+            detector.add(page)
+        detector.finish(self)
 
     def predict_pagenumbers(self):
         """
-        TODO
-
-        Returns: TODO
+        Set expected_page_no on every page from the page numbers find_headers
+        accepted: the best-supported offset if there is one, else the first
+        found number.
 
         """
         print("Found page numbers: %s" % self.found_pagenumbers)
         if all(i is None for i in self.found_pagenumbers):
             for i in range(len(self.page_list)):
                 self.page_list[i].expected_page_no = None
+        elif self.pagenumber_offset is not None:
+            # the numbering most pages agree on, rather than whichever page happened to come first
+            print("Page numbering starts at %s (%.0f%% of pages agree)" % (self.pagenumber_offset, 100 * self.pagenumber_confidence))
+            self.expected_pagenumbers = range(self.pagenumber_offset, self.pagenumber_offset + len(self.found_pagenumbers))
+            for i, _ in enumerate(self.page_list):
+                self.page_list[i].expected_page_no = self.expected_pagenumbers[i]
         else:
             start, val = next((i, val) for i, val in enumerate(self.found_pagenumbers) if val is not None)
             self.expected_pagenumbers = range(val-start, val + len(self.found_pagenumbers) - start)
             for i, _ in enumerate(self.page_list):
                 self.page_list[i].expected_page_no = self.expected_pagenumbers[i]
 
+    def get_phrase_index(self):
+        """
+        Returns: a PhraseIndex over self.repeated_phrases, built once and
+        only rebuilt if find_headers has added phrases since
+
+        """
+        if self.phrase_index is None or len(self.phrase_index) != len(self.repeated_phrases):
+            self.phrase_index = PhraseIndex(self.repeated_phrases, self.similarity)
+        return self.phrase_index
+
     def remove_headers(self, mode):
         """
         TODO: Docstring for remove_headers.
@@ -261,85 +696,762 @@ class Document(object):
         """
         pass
 
+    def rasterize(self, first_page=1, last_page=None, timeout=300, profile=None):
+        """
+        Render a range of pages with a single Ghostscript call, yielding each
+        page as soon as Ghostscript has finished writing it.
+
+        When rendering to ocr_tmp/, Ghostscript announces "Page N" when it
+        *starts* a page, so page N-1 is complete at that point, and the last
+        page is complete when the process exits. The "Processing pages A
+        through B." banner gives self.number_of_pages, which replaces a
+        separate page-counting gs call. When self.render_profile pipes pages,
+        gs runs quietly and writes concatenated PNM images to stdout; each one
+        is a page. That stream says nothing about how many pages there are
+        (gs dying partway through looks like a shorter document), so the
+        page count has to be known beforehand (see count_pages).
+
+        A gs that exits with an error is reported and sets self.render_failed;
+        the pages it didn't finish are simply never yielded.
+
+        Args:
+            first_page (int): 1-indexed first page to render
+            last_page (int): last page to render, or None for the end of the document
+            timeout (int): seconds without progress before gs is killed
+            profile (RenderProfile): how to render, if not self.render_profile
+
+        Returns: generator of (page number, path to the rendered image or the
+        image itself as bytes)
+
+        """
+        if profile is None:
+            profile = self.render_profile
+        range_args = "-dFirstPage=%d" % first_page
+        if last_page is not None:
+            range_args += " -dLastPage=%d" % last_page
+        if profile.pipe:
+            range_args = "-q " + range_args
+            output = "-"
+        else:
+            # gs numbers %d outputs from 1 within each call, not by PDF page
+            output = "%(working_dir)socr_tmp/range-%(first)d_%%d.%(ext)s" % {"working_dir" : self.working_dir, "first" : first_page, "ext" : profile.extension()}
+        cmd = "gs %(range)s -dBATCH -dNOPAUSE %(profile)s -sOutputFile='%(output)s' '%(input)s'" % {"range" : range_args, "profile" : profile.gs_args(), "output" : output, "input": self.pdf_path}
+        if profile.pipe:
+            proc = self.children.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        else:
+            proc = self.children.popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+        def kill():
+            print("Process timed out at %s! cmd:" % datetime.datetime.now())
+            print("\t%s" % cmd)
+            kill_group(proc)
+        watchdog = threading.Timer(timeout, kill)
+        watchdog.start()
+
+        current = None
+        try:
+            if profile.pipe:
+                page = first_page
+                image = PageTriage.read_pnm(proc.stdout)
+                while image is not None:
+                    watchdog.cancel()
+                    yield page, image
+                    watchdog = threading.Timer(timeout, kill)
+                    watchdog.start()
+                    page += 1
+                    image = PageTriage.read_pnm(proc.stdout)
+            else:
+                for line in proc.stdout:
+                    banner = re.match(r"Processing pages (\d+) through (\d+)\.", line)
+                    started = re.match(r"Page (\d+)$", line.strip())
+                    if banner is not None:
+                        self.number_of_pages = max(self.number_of_pages or 0, int(banner.group(2)))
+                    elif started is not None:
+                        # no timing gs while the consumer is busy with a page
+                        watchdog.cancel()
+                        if current is not None:
+                            yield current, output % (current - first_page + 1)
+                        current = int(started.group(1))
+                        watchdog = threading.Timer(timeout, kill)
+                        watchdog.start()
+            proc.wait()
+        finally:
+            watchdog.cancel()
+            if proc.poll() is None:
+                # the consumer stopped early (or gave up on the document)
+                kill_group(proc)
+                proc.wait()
+            self.children.finished(proc)
+        if proc.returncode != 0:
+            # killed by the watchdog, or gs gave up on the PDF
+            print("ERROR\tGhostscript exited with status %s rendering %s from page %d" % (proc.returncode, self.pdf_path, first_page))
+            self.render_failed = True
+        # a killed or failed gs may have left the page it was on half-written
+        if current is not None and proc.returncode == 0:
+            yield current, output % (current - first_page + 1)
+
+    def count_pages(self, timeout=300):
+        """
+        Ask Ghostscript for the PDF's page count (pdfpagecount), for when
+        neither the text layer nor the OCR cache has supplied it and pages are
+        piped, so rasterize can't read it off gs's banner.
+
+        Returns: the page count, also set as self.number_of_pages, or None
+        """
+        cmd = "gs -q -dNODISPLAY -dNOSAFER -c \"(%s) (r) file runpdfbegin pdfpagecount = quit\"" % self.pdf_path
+        status, out, _ = call(cmd, timeout=timeout, children=self.children)
+        try:
+            if status != 0:
+                raise ValueError("gs exited with status %s" % status)
+            self.number_of_pages = int(out)
+        except (TypeError, ValueError) as ex:
+            print("ERROR\t Could not get number of pages. Possible document is not a PDF! (%s): %s" % (self.pdf_path, ex))
+            return None
+        return self.number_of_pages
+
+    def rasterize_all(self):
+        """
+        Render every page of the document, in self.render_chunk sized page
+        ranges (or all at once if render_chunk is None).
+
+        Returns: generator of (page number, path to the rendered image)
+
+        """
+        if not self.render_chunk:
+            for rendered in self.rasterize():
+                yield rendered
+        else:
+            first = 1
+            while True:
+                last = first + self.render_chunk - 1
+                for rendered in self.rasterize(first, last):
+                    yield rendered
+                # gs clamps the banner's last page to the document length, so
+                # a short banner means this was the final range
+                if self.number_of_pages is None or self.number_of_pages < last:
+                    break
+                first = last + 1
+
+        if self.number_of_pages is None:
+            print("ERROR\t Could not get number of pages. Possible document is not a PDF! (%s)" % self.pdf_path)
+
+    def extract_text_layer(self, timeout=300):
+        """
+        Pull the embedded text out of every page with Ghostscript's txtwrite
+        device (one call, one file per page) and keep the pages whose text
+        passes text_layer_usable, writing them to ocr/ where tesseract's
+        output would go. Also sets self.number_of_pages from gs's banner.
+
+        With an OCR cache, which pages were usable and their text are cached
+        too, and a later run restores them from there without starting gs.
+        The decisions aren't redone if the rulesets' dictionary changes.
+
+        Returns: set of page numbers that don't need OCR
+        """
+        cache = self.ocr_cache
+        if cache is not None and cache.number_of_pages() is not None and cache.text_layer_pages() is not None:
+            usable = cache.text_layer_pages()
+            if all(path.exists(cache.entry(page, "txt")) for page in usable):
+                for page in usable:
+                    cache.restore(page, self.ocr_output_base(page), ("txt",))
+                self.number_of_pages = cache.number_of_pages()
+                print("Text layer: %d of %d pages usable without OCR (cached)" % (len(usable), self.number_of_pages))
+                return usable
+        if Volume2.corrector is None:
+            # nothing to score the text with
+            return set()
+        output = "%socr_tmp/text-%%d.txt" % self.working_dir
+        cmd = "gs -dBATCH -dNOPAUSE -sDEVICE=txtwrite -sOutputFile='%(output)s' '%(input)s'" % {"output" : output, "input" : self.pdf_path}
+        status, outs, _ = call(cmd, timeout=timeout, children=self.children)
+        banner = re.search(r"Processing pages (\d+) through (\d+)\.", (outs or b"").decode("utf-8", "replace"))
+        if status != 0 or banner is None:
+            print("ERROR\tCould not read the text layer of %s; OCRing every page" % self.pdf_path)
+            return set()
+        self.number_of_pages = int(banner.group(2))
+
+        usable = set()
+        for page in range(1, self.number_of_pages + 1):
+            text_path = output % page
+            if not path.exists(text_path):
+                continue # gs writes nothing for some pages without text
+            with codecs.open(text_path, "r", "utf-8", errors="replace") as fin:
+                text = fin.read()
+            os.remove(text_path)
+            if text_layer_usable(text.split("\n")):
+                with codecs.open(self.ocr_output_base(page) + ".txt", "w", "utf-8") as fout:
+                    fout.write(text)
+                if cache is not None:
+                    cache.store(page, self.ocr_output_base(page), ("txt",))
+                usable.add(page)
+        if cache is not None:
+            cache.set_number_of_pages(self.number_of_pages)
+            cache.set_text_layer_pages(usable)
+        print("Text layer: %d of %d pages usable without OCR" % (len(usable), self.number_of_pages))
+        return usable
+
+    def triage(self, pages):
+        """
+        Render pages with TRIAGE_PROFILE, in one Ghostscript call per run of
+        pages, and sort them with PageTriage.triage_page.
+
+        Args:
+            pages (list): sorted page numbers
+
+        Returns: {page number: "blank" | "image" | "text"}
+        """
+        kinds = {}
+        for first, last in page_ranges(pages, self.render_chunk):
+            for page, image in self.rasterize(first, last, profile=TRIAGE_PROFILE):
+                kinds[page] = PageTriage.triage_page(image, TRIAGE_PROFILE.dpi)
+        if not kinds:
+            return kinds
+        counts = dict((kind, list(kinds.values()).count(kind)) for kind in ("blank", "image", "text"))
+        print("Triage: %(blank)d blank, %(image)d image-only and %(text)d text pages" % counts)
+        return kinds
+
+    def write_blank_page(self, page):
+        """
+        Write empty txt and hocr files for a page triage found blank, so it
+        keeps its place in page_files, and add them to the OCR cache.
+        """
+        out_base = self.ocr_output_base(page)
+        with open(out_base + ".txt", "w", encoding="utf-8") as fout:
+            fout.write("")
+        with open(out_base + ".hocr", "w", encoding="utf-8") as fout:
+            fout.write(TesseractAPI.HOCR_HEADER % "(page triage)" + TesseractAPI.HOCR_FOOTER)
+        if self.ocr_cache is not None:
+            self.ocr_cache.store(page, out_base)
+
+    def abandon(self, futures=()):
+        """
+        Stop all work on the document: pages still queued for OCR are
+        cancelled and every gs and tesseract process it has running is
+        killed, so threads busy with a page finish straight away (except for
+        an in-process tesseract, which can't be interrupted and finishes the
+        page it is on). Nothing is started for the document afterwards.
+
+        Args:
+            futures: OCR futures to cancel
+        """
+        for future in futures:
+            future.cancel()
+        self.children.kill()
+
+    def ocr_output_base(self, page):
+        """
+        Returns: path, minus extension, of the txt/hocr files for a page
+        """
+        return "%(working_dir)socr/page_%(page)s" % {"working_dir" : self.working_dir, "page" : page}
+
+    def ocr_page(self, page, image):
+        """
+        Run tesseract over a rendered page, writing txt and hocr into ocr/,
+        and add the result to the OCR cache.
+
+        Args:
+            page (int): 1-indexed page number
+            image (str or bytes): path to the rendered page, or the raster
+                itself, which is piped to tesseract over stdin
+
+        Returns: (status, path to the OCRed text)
+
+        """
+        out_base = self.ocr_output_base(page)
+        if self.children.killed:
+            # abandoned; don't queue up for a shared slot
+            return 1, out_base + ".txt"
+        # an image-only page's few words aren't worth a second tier
+        max_tiers = 1 if page in self.image_pages else None
+        if self.ocr_slots is not None:
+            # batch mode: tesseract slots are shared with every other document
+            with self.ocr_slots:
+                status = self.recognize(image, out_base, max_tiers)
+        else:
+            status = self.recognize(image, out_base, max_tiers)
+        if status == 0 and self.ocr_cache is not None:
+            self.ocr_cache.store(page, out_base)
+        return status, out_base + ".txt"
+
+    def tiers(self):
+        """
+        Returns: tesseract argument strings for each OCR tier (see ocr_tiers)
+        """
+        if self.adaptive_oem:
+            return ocr_tiers(self.tesseract_args)
+        return [self.tesseract_args]
+
+    def start_engine(self):
+        single_threaded = self.ocr_workers > 1
+        self.engines = []
+        self.tier_stats = []
+        for args in self.tiers():
+            self.engines.append((make_engine(self.ocr_engine, args, single_threaded, self.children),
+                SubprocessEngine(args, single_threaded, self.children)))
+            self.tier_stats.append({"args" : args, "pages" : 0, "seconds" : 0.0, "low_confidence" : 0, "retry_failed" : 0})
+
+    def recognize(self, image, out_base, max_tiers=None):
+        """
+        OCR a page tier by tier: each tier's engine, retrying with the
+        tesseract binary if that fails and isn't already what the engine is.
+        A page moves on to the next tier if it failed or its mean word
+        confidence is below self.retry_confidence; the last tier's output is
+        kept whatever it is, unless that tier failed where an earlier one had
+        only come out with low confidence, in which case the earlier output
+        is kept.
+
+        Args:
+            max_tiers (int): stop after this many tiers, if given
+
+        Returns: 0 on success
+        """
+        if self.engines is None:
+            self.start_engine()
+        last = len(self.engines) - 1
+        if max_tiers is not None:
+            last = min(last, max_tiers - 1)
+        kept = None
+        for tier, (engine, fallback) in enumerate(self.engines[:last + 1]):
+            if self.children.killed:
+                # abandoned, and an in-process engine can't be stopped by killing anything
+                return 1
+            start = time.time()
+            status = engine.recognize(image, out_base)
+            if status != 0 and not isinstance(engine, SubprocessEngine):
+                print("ERROR\tIn-process tesseract failed on %s; retrying with the binary" % out_base)
+                status = fallback.recognize(image, out_base)
+            low_confidence = False
+            if tier < last and status == 0:
+                confidence = hocr_confidence(out_base + ".hocr")
+                low_confidence = confidence is not None and confidence < self.retry_confidence
+            with self.stats_lock:
+                stats = self.tier_stats[tier]
+                stats["pages"] += 1
+                stats["seconds"] += time.time() - start
+                if low_confidence:
+                    stats["low_confidence"] += 1
+                if status != 0 and kept is not None:
+                    stats["retry_failed"] += 1
+            if status != 0 and kept is not None:
+                # a low-confidence page beats no page
+                print("ERROR\tOCR tier %d failed on %s; keeping tier %d's output" % (tier + 1, out_base, kept + 1))
+                for ext in ("txt", "hocr"):
+                    os.replace("%s.tier%d.%s" % (out_base, kept + 1, ext), "%s.%s" % (out_base, ext))
+                return 0
+            if kept is not None:
+                for ext in ("txt", "hocr"):
+                    os.remove("%s.tier%d.%s" % (out_base, kept + 1, ext))
+                kept = None
+            if tier == last or (status == 0 and not low_confidence):
+                return status
+            if low_confidence:
+                # set aside in case the next tier fails outright
+                for ext in ("txt", "hocr"):
+                    os.replace("%s.%s" % (out_base, ext), "%s.tier%d.%s" % (out_base, tier + 1, ext))
+                kept = tier
+
     def ocr(self):
         """
-        Run OCR on the document.
+        Run OCR on the document. Ghostscript renders the document in one pass
+        (see rasterize_all) and each page is handed to a pool of
+        self.ocr_workers tesseract threads as soon as it is written, so OCR of
+        early pages overlaps with rendering of later ones. page_files stays
+        in page order regardless of the order in which pages finish; pages
+        that fail are left out of it and recorded in self.failed_pages as
+        {page number: "render" | "ocr"}.
+
+        Pages already in the OCR cache (see OCRCache.py) are copied into ocr/
+        instead. Once a run has recorded the page count, only the missing page
+        ranges are rendered at all. Pages with a usable text layer (see
+        extract_text_layer) are never rendered or OCRed either, and the cache
+        remembers which those are, so re-running a finished document never
+        starts gs or tesseract.
+
+        Pages are OCRed in the fast LSTM-only mode first, and only the ones
+        that come out with low confidence are run again in the slower mode
+        tesseract_args asks for (see ocr_tiers and recognize). Before any of
+        that, pages still to be OCRed go through triage: blank pages get
+        empty placeholder files instead, and image-only pages only get the
+        fast pass.
+
         Returns: 0 if all pages successful, else 1
 
         """
-        check = True
-        for i in range(1, self.number_of_pages + 1):
-            pagecheck, _, _ = call("gs -dFirstPage=%(page)s -dLastPage=%(page)s -dBATCH -dNOPAUSE -sDEVICE=png16m -dGraphicsAlphaBits=4 -dTextAlphaBits=4 -r600 -sOutputFile='%(working_dir)s/ocr_tmp/page-%(page)d.png' '%(input)s'" % {"working_dir" : self.working_dir, "page" : i, "input": self.pdf_path})
-            tesscheck, _, _ = call("tesseract %(working_dir)s/ocr_tmp/page-%(page)s.png %(working_dir)s/ocr/page_%(page)s -l eng --psm 1 --oem 2 txt hocr" % {"working_dir" : self.working_dir, "page" : i})
-            if tesscheck == 0:
-                self.page_files.append(self.working_dir + "/ocr/page_%(page)s.txt" %{"page" : i})
-            check = check and pagecheck and tesscheck
-        return check
+        if self.cache_dir is not None:
+            settings = "%s %s" % (self.render_profile.cache_key(), self.tesseract_args)
+            if len(self.tiers()) > 1:
+                # pages can come from a faster tier, so the policy is part of the key
+                settings += " retry below %s" % self.retry_confidence
+            if self.triage_pages:
+                settings += " triage"
+            self.ocr_cache = OCRCache(self.cache_dir, self.pdf_path, settings)
 
-def main():
-    # ASSUME: This is going to be run _within_ the docker container that has gs, tesseract, etc installed
-    if len(sys.argv) == 1:
-        input_dir = os.getcwd() + "/input/"
-    else:
-        input_dir = path.abspath(sys.argv[1])
-    print("Looking for PDFs in %s" % input_dir)
-    Volume2.importrules("/usr/bin/rulesets/")
-    for document_path in glob.glob(input_dir +"/*.pdf"):
-        document = Document(pdf_path=document_path, working_dir=path.basename(document_path).replace(".pdf", ""))
+        if self.use_text_layer:
+            self.text_layer_pages = self.extract_text_layer()
+        if self.engines is None:
+            # before the thread pool, so its threads don't race to build it
+            self.start_engine()
+        if self.triage_pages and PageTriage.numpy is None:
+            print("ERROR\tPage triage needs numpy; OCRing every page")
+            self.triage_pages = False
 
-        # TODO: parse options
-        # TODO: run only those options
+        restored = set()
+        kinds = {}
+        if self.ocr_cache is not None and self.ocr_cache.number_of_pages() is not None:
+            self.number_of_pages = self.ocr_cache.number_of_pages()
+        if self.number_of_pages is None and (self.triage_pages or self.render_profile.pipe):
+            # piped pages can't be counted: only rasterize to ocr_tmp/ reads
+            # the count off gs's banner
+            if self.count_pages() is None:
+                return 1
+        if self.number_of_pages is not None:
+            for page in range(1, self.number_of_pages + 1):
+                if page in self.text_layer_pages:
+                    continue
+                if self.ocr_cache is not None and self.ocr_cache.restore(page, self.ocr_output_base(page)):
+                    restored.add(page)
+            if self.triage_pages:
+                kinds = self.triage([page for page in range(1, self.number_of_pages + 1)
+                    if page not in restored and page not in self.text_layer_pages])
+            for page, kind in sorted(kinds.items()):
+                if page in restored or page in self.text_layer_pages:
+                    continue
+                if kind == "blank":
+                    self.write_blank_page(page)
+                    self.blank_pages.add(page)
+                    restored.add(page)
+                elif kind == "image":
+                    self.image_pages.add(page)
+            missing = [page for page in range(1, self.number_of_pages + 1) if page not in restored and page not in self.text_layer_pages]
+            rendered = chain.from_iterable(self.rasterize(first, last) for first, last in page_ranges(missing, self.render_chunk))
+        else:
+            rendered = self.rasterize_all()
 
-        document.ocr()
-        document.prep_pagefiles()
+        pending = {}
+        # gs renders far faster than tesseract reads, and a piped page is a
+        # whole raster, so only a few pages may wait for a thread; gs blocks
+        # on its pipe until there's room
+        in_flight = threading.BoundedSemaphore(2 * self.ocr_workers)
+        pool = ThreadPoolExecutor(max_workers=self.ocr_workers)
+        try:
+            for page, image in rendered:
+                if page in restored:
+                    continue
+                if self.ocr_cache is not None and self.ocr_cache.restore(page, self.ocr_output_base(page)):
+                    restored.add(page)
+                    continue
+                in_flight.acquire()
+                pending[page] = pool.submit(self.ocr_page, page, image)
+                pending[page].add_done_callback(lambda future: in_flight.release())
+            if self.ocr_cache is not None and self.number_of_pages is not None and not self.render_failed:
+                self.ocr_cache.set_number_of_pages(self.number_of_pages)
+            pool.shutdown(wait=True)
+        except BaseException:
+            # timed out (see process_document), or gs broke: nothing of this
+            # document may go on running once ocr() has returned
+            self.abandon(pending.values())
+            pool.shutdown(wait=True)
+            raise
 
+        for page in range(1, (self.number_of_pages or 0) + 1):
+            if page in restored or page in self.text_layer_pages:
+                self.page_files.append(self.ocr_output_base(page) + ".txt")
+            elif page not in pending:
+                self.failed_pages[page] = "render"
+            else:
+                try:
+                    status, text_path = pending[page].result()
+                except Exception as ex:
+                    # e.g. an OSError writing the page's output or cache
+                    # entry; it's this page that failed, not the document
+                    print("ERROR\tOCR of page %s of %s raised %r" % (page, self.pdf_path, ex))
+                    status = 1
+                if status != 0:
+                    self.failed_pages[page] = "ocr"
+                else:
+                    self.page_files.append(text_path)
+            if page in self.failed_pages:
+                print("ERROR\t%s failed on page %s of %s" % (self.failed_pages[page], page, self.pdf_path))
+        if self.ocr_cache is not None:
+            print("OCR cache: %d pages restored, %d pages added" % (self.ocr_cache.hits, self.ocr_cache.stores))
+        for tier, stats in enumerate(self.tier_stats):
+            print("OCR tier %d (%s): %d pages in %.1fs, %d of them below confidence %s and run again" % (tier + 1, stats["args"], stats["pages"], stats["seconds"], stats["low_confidence"], self.retry_confidence))
+            if stats["retry_failed"]:
+                print("OCR tier %d: retry failed on %d pages, kept the previous tier's output" % (tier + 1, stats["retry_failed"]))
+        if self.number_of_pages is None:
+            return 1
+        return 0 if not self.failed_pages else 1
 
-        # cleanup headers/footers
-        document.find_headers(footer_mode=True)
-        document.find_headers(footer_mode=False)
-        document.predict_pagenumbers() # requires found_pagenumbers, so should be after the find_headers calls
-        document.remove_headers(mode="footer")
-        document.remove_headers(mode="header")
-        document.mid_page_cleanup() # keys in on blank lines, so needs to be _before_ remove_empties
-        document.remove_empties()
+def clean_document(document, rulepath, correction_workers=1):
+    """
+    Everything after OCR: header/footer/page number removal, token
+    correction, and writing the _clean.txt files. Pages are tokenized and
+    corrected on a pool of correction_workers processes. Header detection
+    only reads the ends of each page file; full page text is loaded a window
+    of pages at a time and released once corrected.
+    """
+    document.prep_pagefiles()
 
+    # cleanup headers/footers
+    document.detect_headers()
+    document.predict_pagenumbers() # requires found_pagenumbers, so should be after the find_headers calls
+    if correction_workers > 1:
+        pool = multiprocessing.Pool(correction_workers, initializer=init_correction_worker, initargs=(rulepath,))
+    else:
+        pool = None
 
+    def corrected_pages():
+        # Pages are loaded, cleaned, corrected and released a window at a
+        # time, so only that many pages' text is ever in memory at once.
+        window = max(1, correction_workers) * 8
+        for start in range(0, len(document.page_list), window):
+            batch = document.page_list[start:start + window]
+            pages = []
+            for page in batch:
+                page.clean() # footer, header, mid-page isolated lines, then empties
+                lines = page.page
+                lines[-1] += "\n"
+                pages.append(lines)
+            if pool is not None:
+                results = pool.map(correct_page, pages)
+            else:
+                results = map(correct_page, pages)
+            for page, corrected in zip(batch, results):
+                page.release()
+                yield corrected
 
-        # TODO: incorporate the desired subset of the datamunging cleanup/spellchecker stuff
+    # TODO: incorporate the desired subset of the datamunging cleanup/spellchecker stuff
 
-        document.text = ""
-        document_tokens = []
-        for i, filename in enumerate(document.page_files):
+    def written_pages():
+        for filename, (correct_tokens, document_tokens) in zip(document.page_files, corrected_pages()):
             # TODO: one more pass? Clean up cases of \n<HEADER>\n to get 'first column'
             # TODO and clean up \n\n\n\n\n type stuff..
             print(filename)
-            new_filename = filename.replace(".txt", "_clean.txt")
-            with codecs.open(new_filename, "w", "utf-8") as fout:
-                document.page_list[i].page[-1] += "\n"
-                page_tokens, _, _ = Volume2.as_stream(document.page_list[i].page)
-                correct_tokens, _, _, _ = Volume2.correct_stream(page_tokens)
-                document_tokens += correct_tokens
-                lasttoken = ""
-                for token in correct_tokens:
-                    if lasttoken == '\n' and (token == '"' or token == "'"):
-                        token = token
-                    elif token != '\n' and token != "“" and not (token.startswith('<') and token.endswith('>')):
-                        token = token + " "
-                    fout.write(token)
-                    lasttoken = token
-                    document.text += token
-        # concatenate page text into one dump
-        correct_document_tokens, _, _, _ = Volume2.correct_stream(document_tokens)
-        with codecs.open(document.working_dir + "ocr/document_clean.txt", "w", "utf-8") as fout:
-            for token in correct_document_tokens:
-                if lasttoken == '\n' and (token == '"' or token == "'"):
-                    token = token
-                elif token != '\n' and token != "“" and not (token.startswith('<') and token.endswith('>')):
-                    token = token + " "
-                fout.write(token)
-                lasttoken = token
-                document.text += token
+            with TokenWriter(filename.replace(".txt", "_clean.txt")) as fout:
+                fout.write(correct_tokens)
+            yield document_tokens
+
+    try:
+        # concatenate page text into one dump as the pages go by; pages have
+        # already had the document's second correction pass, so only words
+        # broken across page boundaries need another look. Every page's tokens end in a linebreak, which
+        # is where the old per-token loop left lasttoken.
+        with TokenWriter(document.working_dir + "ocr/document_clean.txt", lasttoken="\n") as fout:
+            fout.write(Volume2.join_pages(written_pages()))
+    except BaseException:
+        if pool is not None:
+            # given up on: don't wait for the pages still being corrected
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if document.phrase_index is not None:
+        print("Repeated phrase lookups: %s" % document.phrase_index.stats)
+    if pool is None:
+        # with a pool, most of the correcting happened in the workers' memos
+        print("Token correction memo: %s" % Volume2.corrector.memo.stats)
+
+def init_correction_worker(rulepath):
+    # forked workers inherit the parent's rules; anything else loads them once here
+    if Volume2.corrector is None:
+        Volume2.importrules(rulepath)
+
+def correct_page(lines):
+    """
+    Tokenize and correct one page's lines. Runs in the correction pool.
 
+    document_clean.txt has always been corrected twice (a second pass can
+    finish what the first started, e.g. "w^ould" or "ssw"), so that second
+    pass is made here too, page by page, rather than over the whole document.
+
+    Returns: (corrected tokens for the page's _clean.txt, the same tokens
+    corrected again for document_clean.txt)
+    """
+    page_tokens = Volume2.tokenize(lines) # as_stream's lexicon scores aren't needed here
+    correct_tokens, _, _, _ = Volume2.correct_stream(page_tokens)
+    document_tokens, _, _, _ = Volume2.correct_stream(correct_tokens)
+    return correct_tokens, document_tokens
+
+class DocumentTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise DocumentTimeout()
+
+def document_status(document_path):
+    """
+    Returns: a manifest entry for a document that hasn't run into trouble yet
+    """
+    return {"document" : document_path, "status" : "ok", "pages" : None, "text_layer_pages" : 0, "blank_pages" : 0, "image_pages" : 0, "failed_pages" : {}, "error" : None}
+
+def process_document(document_path, rulepath, ocr_workers, correction_workers=1, ocr_slots=None, timeout=None, ocr_engine="auto"):
+    """
+    OCR and clean one PDF. Never raises: whatever goes wrong ends up in the
+    returned status, so one bad document can't take a batch down with it.
+
+    Args:
+        document_path (str): the PDF
+        rulepath (str): rulesets directory, for correction workers
+        ocr_workers (int): tesseract threads for this document
+        correction_workers (int): processes correcting this document's pages
+        ocr_slots (Semaphore): shared limit on tesseract runs, or None
+        timeout (int): seconds before the document is abandoned, or None
+        ocr_engine (str): one of OCR_ENGINES
+
+    Returns: status dict for the manifest
+
+    """
+    status = document_status(document_path)
+    start = time.time()
+    document = None
+    if timeout:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(timeout)
+    try:
+        document = Document(pdf_path=document_path, working_dir=path.basename(document_path).replace(".pdf", ""), ocr_workers=ocr_workers, ocr_slots=ocr_slots, ocr_engine=ocr_engine)
+        if document.ocr() != 0:
+            status["status"] = "ocr_failed"
+        status["pages"] = document.number_of_pages
+        status["text_layer_pages"] = len(document.text_layer_pages)
+        status["blank_pages"] = len(document.blank_pages)
+        status["image_pages"] = len(document.image_pages)
+        status["failed_pages"] = document.failed_pages
+        if document.page_files:
+            clean_document(document, rulepath, correction_workers)
+        else:
+            status["status"] = "no_pages"
+    except DocumentTimeout:
+        print("ERROR\t%s timed out after %s seconds" % (document_path, timeout))
+        status["status"] = "timeout"
+        if document is not None:
+            # ocr() cleans up after itself; this catches gs runs outside it
+            document.abandon()
+    except Exception as ex:
+        print("ERROR\tFailed to process %s: %r" % (document_path, ex))
+        status["status"] = "error"
+        status["error"] = repr(ex)
+    finally:
+        if timeout:
+            signal.alarm(0)
+    status["seconds"] = round(time.time() - start, 1)
+    return status
+
+# settings for batch workers: filled in by the parent before run_batch
+# starts a pool, and inherited by the workers it forks
+batch_settings = {}
+
+def batch_document(document_path):
+    # the parent normally loaded the rules before forking
+    if Volume2.corrector is None:
+        Volume2.importrules(batch_settings["rulepath"], batch_settings["shared_rules"], batch_settings["memo_size"],
+                batch_settings["compiled_rules"])
+    # documents already run in parallel, so each corrects its own pages in-process
+    return process_document(document_path, batch_settings["rulepath"], batch_settings["ocr_workers"],
+            ocr_slots=batch_settings["ocr_slots"], timeout=batch_settings["timeout"], ocr_engine=batch_settings["ocr_engine"])
+
+def run_batch(document_paths, jobs, record):
+    """
+    Process documents on a pool of jobs worker processes, handing each
+    document's status to record as it finishes. Workers live on from one
+    document to the next, which keeps the rules and any in-process tesseract
+    loaded; process_document cleans up after a document that times out.
+
+    A worker that dies outright (a crash inside libtesseract, the OOM killer)
+    breaks the whole pool, and every document in flight fails with it.
+    Those documents are queued again to run one at a time on a fresh pool,
+    so the one that really takes its worker down is recorded as "crashed"
+    and the rest of the batch carries on.
+
+    Args:
+        document_paths (list): PDFs to process
+        jobs (int): documents processed at once
+        record (function): called with each document's status dict
+    """
+    queue = deque((document_path, False) for document_path in document_paths)
+    running = {}
+
+    def start_pool():
+        # every document may use up to ocr_workers threads, but the shared
+        # semaphore keeps the number of running tesseracts at ocr_workers
+        # in total; a new one each time, since a worker that died holding a
+        # slot never gave it back
+        batch_settings["ocr_slots"] = multiprocessing.BoundedSemaphore(batch_settings["ocr_workers"])
+        return ProcessPoolExecutor(jobs)
+
+    pool = start_pool()
+    try:
+        while queue or running:
+            # a document that was in flight when the pool broke runs alone
+            while (queue and len(running) < jobs and not any(alone for _, alone in running.values())
+                    and not (queue[0][1] and running)):
+                document_path, alone = queue.popleft()
+                running[pool.submit(batch_document, document_path)] = (document_path, alone)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                document_path, alone = running.pop(future)
+                try:
+                    record(future.result())
+                except BrokenProcessPool:
+                    broken = True
+                    if alone:
+                        print("ERROR\t%s crashed its worker process" % document_path)
+                        status = document_status(document_path)
+                        status["status"] = "crashed"
+                        status["error"] = "worker process died"
+                        record(status)
+                    else:
+                        queue.append((document_path, True))
+            if broken:
+                for future, (document_path, alone) in running.items():
+                    if future.done() and not future.cancelled() and future.exception() is None:
+                        record(future.result())
+                    else:
+                        queue.append((document_path, True))
+                running = {}
+                # a broken pool has already stopped its workers
+                pool.shutdown()
+                pool = start_pool()
+    finally:
+        pool.shutdown()
+
+def main():
+    # ASSUME: This is going to be run _within_ the docker container that has gs, tesseract, etc installed
+    parser = argparse.ArgumentParser(description="OCR and clean up every PDF in a directory.")
+    parser.add_argument("input_dir", nargs="?", default=os.getcwd() + "/input/", help="directory of PDFs")
+    parser.add_argument("--jobs", type=int, default=1, help="documents processed at once, each in its own process")
+    parser.add_argument("--ocr-workers", type=int, default=os.cpu_count() or 1, help="tesseract runs at once, shared by all documents")
+    parser.add_argument("--correction-workers", type=int, default=os.cpu_count() or 1, help="processes correcting pages of a document (without --jobs)")
+    parser.add_argument("--timeout", type=int, default=None, help="seconds before a document is given up on")
+    parser.add_argument("--manifest", default="/output/manifest.jsonl", help="per-document status, one JSON object per line")
+    parser.add_argument("--rulesets", default="/usr/bin/rulesets/")
+    parser.add_argument("--ocr-engine", choices=OCR_ENGINES, default="auto", help="tesseract in-process (api) or as a binary per page (subprocess); auto uses the API if libtesseract is installed")
+    parser.add_argument("--compiled-rules", default=None, help="directory for the compiled rules snapshot (built there if missing or stale); without it the rulesets are parsed on every run")
+    parser.add_argument("--shared-rules", action="store_true", help="map the compiled rule tables read-only, shared by every worker process")
+    parser.add_argument("--memo-size", type=int, default=Volume2.MEMO_SIZE, help="tokens whose correction each process remembers; 0 turns the memo off")
+    args = parser.parse_args()
+
+    input_dir = path.abspath(args.input_dir)
+    print("Looking for PDFs in %s" % input_dir)
+    document_paths = sorted(glob.glob(input_dir +"/*.pdf"))
+
+    with open(args.manifest, "a") as manifest:
+        def record(status):
+            manifest.write(json.dumps(status, sort_keys=True) + "\n")
+            manifest.flush()
+
+        # loaded once here; batch workers are forked with the rules in place
+        Volume2.importrules(args.rulesets, args.shared_rules, args.memo_size, args.compiled_rules)
+        if args.jobs <= 1:
+            for document_path in document_paths:
+                record(process_document(document_path, args.rulesets, args.ocr_workers, args.correction_workers, timeout=args.timeout, ocr_engine=args.ocr_engine))
+        else:
+            batch_settings.update(rulepath=args.rulesets, shared_rules=args.shared_rules, memo_size=args.memo_size,
+                    compiled_rules=args.compiled_rules, ocr_workers=args.ocr_workers,
+                    timeout=args.timeout, ocr_engine=args.ocr_engine)
+            run_batch(document_paths, args.jobs, record)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+"""
+OCRCache.py
+Persistent cache of tesseract output for GeoDeepDive documents.
+Entries are keyed on:
+    the PDF's content hash (so renamed or re-downloaded files still hit)
+    the OCR settings (render profile + tesseract arguments)
+    the page number
+Layout on disk:
+    <cache_dir>/<pdf sha256>/pages                  page count of the PDF
+    <cache_dir>/<pdf sha256>/<settings hash>/page_N.txt
+    <cache_dir>/<pdf sha256>/<settings hash>/page_N.hocr
+    <cache_dir>/<pdf sha256>/<settings hash>/text_layer   pages taken from the PDF's text layer
+Text layer pages only have a page_N.txt.
+Files are written to a temporary name and renamed into place, so a job that
+dies halfway through a page never leaves a truncated entry behind.
+"""
+import hashlib
+import os
+from os import path
+import shutil
+
+EXTENSIONS = ("hocr", "txt")
+
+def hash_file(filepath, blocksize=1 << 20):
+    """
+    Returns: hex sha256 of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fin:
+        block = fin.read(blocksize)
+        while block:
+            digest.update(block)
+            block = fin.read(blocksize)
+    return digest.hexdigest()
+
+class OCRCache(object):
+
+    """Cached txt/hocr output for the pages of one PDF under one set of OCR settings."""
+
+    def __init__(self, cache_dir, pdf_path, settings):
+        """
+        Args:
+            cache_dir (str): root of the cache, shared between documents
+            pdf_path (str): the PDF being OCRed
+            settings (str): everything that changes tesseract's output for a page
+        """
+        self.pdf_dir = path.join(cache_dir, hash_file(pdf_path))
+        settings_hash = hashlib.sha1(settings.encode("utf-8")).hexdigest()[:16]
+        self.entry_dir = path.join(self.pdf_dir, settings_hash)
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self.hits = 0
+        self.stores = 0
+
+    def number_of_pages(self):
+        """
+        Returns: the PDF's page count if an earlier run recorded it, else None
+        """
+        try:
+            with open(path.join(self.pdf_dir, "pages")) as fin:
+                return int(fin.read())
+        except (IOError, ValueError):
+            return None
+
+    def set_number_of_pages(self, number_of_pages):
+        self._write(path.join(self.pdf_dir, "pages"), str(number_of_pages).encode("utf-8"))
+
+    def text_layer_pages(self):
+        """
+        Returns: the set of pages an earlier run took from the PDF's text
+        layer (see set_text_layer_pages), or None if none has recorded it
+        """
+        try:
+            with open(path.join(self.entry_dir, "text_layer")) as fin:
+                return set(int(page) for page in fin.read().split())
+        except (IOError, ValueError):
+            return None
+
+    def set_text_layer_pages(self, pages):
+        """
+        Record which pages came from the text layer. Their text must already
+        have been stored, with store(page, out_base, ("txt",)).
+        """
+        self._write(path.join(self.entry_dir, "text_layer"), " ".join(str(page) for page in sorted(pages)).encode("utf-8"))
+
+    def entry(self, page, ext):
+        return path.join(self.entry_dir, "page_%d.%s" % (page, ext))
+
+    def restore(self, page, out_base, extensions=EXTENSIONS):
+        """
+        Copy a cached page into the working directory, as if tesseract had
+        just written out_base.txt and out_base.hocr.
+
+        Returns: True on a cache hit, False otherwise
+        """
+        if not all(path.exists(self.entry(page, ext)) for ext in extensions):
+            return False
+        for ext in extensions:
+            shutil.copyfile(self.entry(page, ext), "%s.%s" % (out_base, ext))
+        self.hits += 1
+        return True
+
+    def store(self, page, out_base, extensions=EXTENSIONS):
+        """
+        Add tesseract's output for a page (out_base.txt/out_base.hocr) to the cache.
+        """
+        for ext in extensions:
+            with open("%s.%s" % (out_base, ext), "rb") as fin:
+                self._write(self.entry(page, ext), fin.read())
+        self.stores += 1
+
+    def _write(self, filepath, data):
+        tmp_path = "%s.tmp%d" % (filepath, os.getpid())
+        with open(tmp_path, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp_path, filepath)
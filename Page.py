@@ -14,37 +14,82 @@ Should have methods to:
     find_captions -> Extract [\nFig.*\n, \nTable.*\n] type things (maybe John's thing does this already?)
     table/figure extraction (may require document-level stuff as well.)
 """
-from difflib import SequenceMatcher
 import re
 import codecs
+from array import array
+from collections import deque
+from itertools import islice
+
+LINES = 8
+SIMILARITY = 0.8
+# in geometry mode, header and footer candidates are the lines whose middle
+# is in the top or bottom BAND of the page
+BAND = 0.1
+# lines that count as empty when trimming the ends of a page
+is_blank = re.compile(r"^\s?$").match
+# the page, and the elements tesseract writes a line of text as
+hocr_element = re.compile(r"""class=['"](ocr_page|ocr_line|ocr_header|ocr_caption|ocr_textfloat)['"][^>]*?title=(['"])(.*?)\2""")
+hocr_bbox = re.compile(r"bbox (\d+) (\d+) (\d+) (\d+)")
+
+def read_hocr_lines(hocr_path):
+    """
+    Returns: (page height, [(top, bottom) of each line of text, in order]),
+    or None if the file can't be read or has no page bounding box
+    """
+    try:
+        with codecs.open(hocr_path, "r", "utf-8", errors="replace") as fin:
+            hocr = fin.read()
+    except IOError:
+        return None
+    height = None
+    lines = []
+    for element in hocr_element.finditer(hocr):
+        bbox = hocr_bbox.search(element.group(3))
+        if bbox is None:
+            continue
+        top, bottom = int(bbox.group(2)), int(bbox.group(4))
+        if element.group(1) == "ocr_page":
+            height = bottom
+        else:
+            lines.append((top, bottom))
+    if not height:
+        return None
+    return height, lines
 
 class Page(object):
 
-    """TODO"""
+    """
+    One OCRed page. The (trimmed) text is held as a single string plus an
+    array of line offsets rather than a list of line strings; cleanup marks
+    lines deleted, or overrides their text, instead of copying lists.
+
+    In geometry mode, header and footer candidates are picked by where the
+    lines sit on the page (from tesseract's hOCR) instead of by how near
+    they are to the start or end of the text. Pages without a usable hOCR
+    file fall back to the text mode.
+    """
+
+    __slots__ = ("Document", "txt_path", "page_index", "expected_page_no", "found_page_no",
+                 "edges", "buffer", "offsets", "deleted", "overrides", "geometry", "bands")
 
     def __init__(self, filepath, parent_document, page_index, *args, **kwargs):
         """
         self.page = ["The lines", "on the page", "which get read in here", "but could probably be done cleverly without reading into memory if I want/need"]
         """
-        for key, val in kwargs.items():
-            setattr(self, key, val)
-
         self.Document = parent_document # need access to the document's found headers, etc.
-        self.filepath = {} # hocr, txt, png, pdf
-        self.filepath["txt"] = filepath
-
-        with codecs.open(self.filepath["txt"], 'r', 'utf-8') as fin:
-            clean_page = []
-            temp_page = fin.read().split("\n")
-            non_empty_lines = [i for i, val in enumerate(temp_page) if (val != "" and val != "\n")]
-            if non_empty_lines == []:
-                clean_page = ['']
-            else:
-                try:
-                    clean_page = (temp_page[non_empty_lines[0]:non_empty_lines[-1]+1])
-                except:
-                    import pdb; pdb.set_trace()
-            self.page = clean_page
+        self.txt_path = filepath
+
+        # The full text is only read when something needs it, and can be
+        # dropped again with release(). Header/footer detection only needs
+        # the ends of the page, which read_edges gets without holding on to
+        # the rest.
+        self.buffer = None
+        self.offsets = None
+        self.deleted = None
+        self.overrides = None
+        self.edges = None
+        self.geometry = False
+        self.bands = None
 
         self.page_index = page_index
 
@@ -52,6 +97,159 @@ class Page(object):
         self.expected_page_no = self.Document.expected_pagenumbers[self.page_index]
         self.found_page_no = self.Document.expected_pagenumbers[self.page_index]
 
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    @property
+    def page(self):
+        """
+        The page's current lines, as a new list.
+        """
+        self.load()
+        return [self.line(i) for i in self.live()]
+
+    @page.setter
+    def page(self, lines):
+        self.store(lines)
+
+    def load(self):
+        if self.buffer is None:
+            self.store(self.read_page())
+
+    def store(self, lines):
+        """
+        Replace the page's text with lines, packed into one buffer.
+        """
+        self.buffer = "\n".join(lines) + "\n"
+        self.offsets = array("L", [0])
+        for line in lines:
+            self.offsets.append(self.offsets[-1] + len(line) + 1)
+        self.deleted = bytearray(len(lines))
+        self.overrides = {}
+
+    def release(self):
+        """
+        Forget the page text (e.g. once its cleaned output is written). The
+        next access to self.page reads the original text again.
+        """
+        self.buffer = self.offsets = self.deleted = self.overrides = None
+
+    def line(self, i):
+        if i in self.overrides:
+            return self.overrides[i]
+        return self.buffer[self.offsets[i]:self.offsets[i + 1] - 1]
+
+    def live(self):
+        """
+        Returns: generator of the indexes of lines not marked deleted
+        """
+        deleted = self.deleted
+        return (i for i in range(len(deleted)) if not deleted[i])
+
+    def read_page(self):
+        """
+        Returns: the lines of the text file, minus leading/trailing empty lines
+        """
+        with codecs.open(self.txt_path, 'r', 'utf-8') as fin:
+            temp_page = fin.read().split("\n")
+        non_empty_lines = [i for i, val in enumerate(temp_page) if (val != "" and val != "\n")]
+        if non_empty_lines == []:
+            return ['']
+        return temp_page[non_empty_lines[0]:non_empty_lines[-1]+1]
+
+    def read_edges(self):
+        """
+        The first LINES+1 and last LINES lines of what read_page would return,
+        streamed from the file so the middle of the page never stays in memory.
+
+        Returns: (head, tail) as lists of (line index, line)
+
+        """
+        head = []
+        recent = deque(maxlen=LINES)
+        tail = []
+        idx = -1
+        trailing_blanks = 0
+        with open(self.txt_path, 'rb') as fin:
+            for raw in fin:
+                if raw.endswith(b"\n"):
+                    raw = raw[:-1]
+                line = raw.decode('utf-8')
+                if idx < 0 and line == "":
+                    continue
+                idx += 1
+                if len(head) <= LINES:
+                    head.append((idx, line))
+                if line == "":
+                    if trailing_blanks == 0:
+                        # the page may end here; remember what its last lines were
+                        tail = list(recent)
+                    trailing_blanks += 1
+                else:
+                    trailing_blanks = 0
+                recent.append((idx, line))
+        if idx < 0:
+            return [(0, '')], [(0, '')]
+        if trailing_blanks == 0:
+            tail = list(recent)
+        last = idx - trailing_blanks
+        head = [(i, line) for i, line in head if i <= last]
+        return head, tail
+
+    def read_bands(self):
+        """
+        The lines in the top and bottom BAND of the page. The non-blank lines
+        of the text file and the lines in the hOCR file next to it come in
+        the same order, so they are simply paired up.
+
+        Returns: (head, tail) as lists of (line index, line), like read_edges,
+        each in order down the page; or None if there's no hOCR file or it
+        doesn't have one line per non-blank line of text
+
+        """
+        if not self.txt_path.endswith(".txt"):
+            return None
+        geometry = read_hocr_lines(self.txt_path[:-len(".txt")] + ".hocr")
+        if geometry is None:
+            return None
+        height, boxes = geometry
+        head = []
+        tail = []
+        idx = -1
+        ordinal = 0
+        with open(self.txt_path, 'rb') as fin:
+            for raw in fin:
+                if raw.endswith(b"\n"):
+                    raw = raw[:-1]
+                line = raw.decode('utf-8')
+                if idx < 0 and line == "":
+                    continue
+                idx += 1
+                if line.strip() == "":
+                    continue
+                if ordinal == len(boxes):
+                    return None
+                top, bottom = boxes[ordinal]
+                ordinal += 1
+                middle = (top + bottom) / 2.0
+                if middle <= height * BAND:
+                    head.append((middle, idx, line))
+                elif middle >= height * (1 - BAND):
+                    tail.append((middle, idx, line))
+        if ordinal != len(boxes):
+            return None
+        return [(i, line) for _, i, line in sorted(head)], [(i, line) for _, i, line in sorted(tail)]
+
+    def get_bands(self):
+        """
+        Returns: read_bands(), read once, or None if not in geometry mode
+        """
+        if not self.geometry:
+            return None
+        if self.bands is None:
+            self.bands = self.read_bands() or False
+        return self.bands or None
+
     def get_firsttwo(self, footer_mode):
         """
         TODO: Docstring for get_firstwo.
@@ -62,20 +260,42 @@ class Page(object):
         Returns: TODO
 
         """
-        LINES = 8
         thesetwo = list()
         thesepagenos = list()
         linesaccepted = 0
 
-        if footer_mode:
-            lines_it = reversed(list(enumerate(self.page))) # gross..
+        bands = self.get_bands()
+        if bands is not None:
+            # the lines nearest that edge of the page, wherever they are in the text
+            head, tail = bands
+            if footer_mode:
+                lines_it = reversed(tail)
+            else:
+                lines_it = iter(head)
+            length = None
+        elif self.buffer is not None:
+            page = self.page
+            if footer_mode:
+                lines_it = reversed(list(enumerate(page))) # gross..
+            else:
+                lines_it = enumerate(page)
+            length = len(page)
         else:
-            lines_it = enumerate(self.page)
+            # the page isn't loaded: the ends of the file are all we need
+            if self.edges is None:
+                self.edges = self.read_edges()
+            head, tail = self.edges
+            if footer_mode:
+                lines_it = reversed(tail)
+                length = tail[-1][0] + 1
+            else:
+                lines_it = iter(head)
+                length = None
         for idx, line in lines_it:
 
-            if not footer_mode and idx > LINES:
+            if bands is None and not footer_mode and idx > LINES:
                 break
-            elif footer_mode and idx < len(self.page) - LINES:
+            elif bands is None and footer_mode and idx < length - LINES:
                 break
 
             line = line.strip()
@@ -116,39 +336,33 @@ class Page(object):
         Returns: TODO
         """
 
-        LINES = 8
-
+        page = self.page
         valid_modes = ["header", "footer", "full_page"]
         if mode not in valid_modes:
             print("Invalid scan mode supplied! Choose one of (%s)" % (valid_modes))
         if mode == "header":
-            lines = range(min(LINES, len(self.page)))
+            lines = range(min(LINES, len(page)))
         elif mode == "footer":
-            lines = range(max(0, len(self.page) - 1 - LINES), len(self.page))
+            lines = range(max(0, len(page) - 1 - LINES), len(page))
         elif mode == "full_page":
-            lines = range(1, len(self.page)-1)
+            lines = range(1, len(page)-1)
 
         # remove pagenumbers based on string matching
-        ignore_lines = []
+        phrase_index = self.Document.get_phrase_index()
+        ignore_lines = set()
         for i in lines:
             if mode == "full_page": # only check for similarity if the string is isolated
-                if self.page[i-1] != "" or self.page[i+1] != "":
+                if page[i-1] != "" or page[i+1] != "":
                     continue
 
-            # loop over known headers, remove any any similar strings
-            for rep in self.Document.repeated_phrases:
-                rep = str(rep)
-                try:
-                    seq = SequenceMatcher(None, rep, self.page[i])
-                except IndexError:
-                    print(i)
-                if seq.ratio() > 0.8:
-                    ignore_lines.append(i)
+            # check against known headers, remove any any similar strings
+            if phrase_index.matches(page[i], SIMILARITY):
+                ignore_lines.add(i)
             # remove any instance of the expected self.page number
-            self.page[i] = self.page[i].replace(str(self.expected_page_no), "")
+            page[i] = page[i].replace(str(self.expected_page_no), "")
 
-        cleaned_page = [val for i, val in enumerate(self.page) if i not in ignore_lines]
-        non_empty_lines = [i for i, val in enumerate(cleaned_page) if re.match(r"^\s?$", val) is None]
+        cleaned_page = [val for i, val in enumerate(page) if i not in ignore_lines]
+        non_empty_lines = [i for i, val in enumerate(cleaned_page) if is_blank(val) is None]
         if non_empty_lines == []:
             cleaned_page = ['']
         else:
@@ -166,15 +380,146 @@ class Page(object):
         Returns: TODO
 
         """
+        page = self.page
         temp = []
-        ignore_lines = []
-        for i in range(len(self.page)-1):
+        ignore_lines = set()
+        for i in range(len(page)-1):
             if i in ignore_lines:
                 continue
-            if i+2 < len(self.page): # look forward -- if the next line looks like it's breaking a sentence, skip it on next iteration
-                if self.page[i] != '' and self.page[i+1] == '' and self.page[i+2] != '' and not self.page[i].endswith('.') and self.page[i+2][0].islower():
-                    ignore_lines.append(i+1)
-            if not (self.page[i] == '' and self.page[i+1] == ''): # eliminate chains of ''
-                temp.append(self.page[i])
-        temp.append(self.page[-1])
+            if i+2 < len(page): # look forward -- if the next line looks like it's breaking a sentence, skip it on next iteration
+                if page[i] != '' and page[i+1] == '' and page[i+2] != '' and not page[i].endswith('.') and page[i+2][0].islower():
+                    ignore_lines.add(i+1)
+            if not (page[i] == '' and page[i+1] == ''): # eliminate chains of ''
+                temp.append(page[i])
+        temp.append(page[-1])
         self.page = temp
+
+    def clean(self):
+        """
+        Everything Document.remove_headers("footer"), remove_headers("header"),
+        mid_page_cleanup() and remove_empties() do to this page, in that
+        order, with the same result, but without rebuilding the page list
+        after every step: lines are only marked deleted (or have their text
+        overridden when a page number is blanked out). Header and footer
+        lines only ever touch the ends of the page; isolated lines, trimming
+        and blank-line chains are then handled by one streaming pass over
+        what is left.
+
+        In geometry mode, the header and footer candidates are the lines in
+        the page's top and bottom bands instead, and no other line is
+        compared with the repeated phrases.
+        """
+        self.load()
+        phrase_index = self.Document.get_phrase_index()
+        pageno = str(self.expected_page_no)
+        deleted = self.deleted
+        view = list(self.live())
+        bands = self.get_bands()
+
+        # footer, then header: only the last LINES+1/first LINES lines are candidates
+        for mode in ("footer", "header"):
+            if bands is not None:
+                window = [i for i, _ in bands[1 if mode == "footer" else 0] if not deleted[i]]
+            elif mode == "footer":
+                window = view[max(0, len(view) - 1 - LINES):]
+            else:
+                window = view[:min(LINES, len(view))]
+            for i in window:
+                line = self.line(i)
+                if phrase_index.matches(line, SIMILARITY):
+                    deleted[i] = 1
+                self.set_line(i, line.replace(pageno, ""))
+            view = self.trim_view([i for i in view if not deleted[i]])
+
+        def isolated():
+            # only check for similarity if the string is isolated
+            for p, i in enumerate(view):
+                line = self.line(i)
+                # in geometry mode the bands were the only candidates
+                if bands is None and 0 < p < len(view) - 1 and self.line(view[p-1]) == "" and self.line(view[p+1]) == "":
+                    drop = phrase_index.matches(line, SIMILARITY)
+                    line = line.replace(pageno, "")
+                    self.set_line(i, line)
+                    if drop:
+                        continue
+                yield i, line
+
+        kept = set(i for i, _ in join_broken_lines(trim_lines(isolated())))
+        for i in view:
+            if i not in kept:
+                deleted[i] = 1
+        if not kept:
+            self.revive_blank()
+
+    def set_line(self, i, text):
+        if text != self.line(i):
+            self.overrides[i] = text
+
+    def revive_blank(self):
+        """
+        A page with nothing left on it is a single empty line.
+        """
+        self.deleted[0] = 0
+        self.overrides[0] = ''
+
+    def trim_view(self, view):
+        """
+        Mark blank lines at both ends of a view of line indexes deleted.
+        Returns: what is left of the view
+        """
+        start, stop = 0, len(view)
+        while start < stop and is_blank(self.line(view[start])):
+            start += 1
+        while stop > start and is_blank(self.line(view[stop - 1])):
+            stop -= 1
+        for i in view[:start] + view[stop:]:
+            self.deleted[i] = 1
+        if start == stop:
+            self.revive_blank()
+            return [0]
+        return view[start:stop]
+
+def trim_lines(lines):
+    """
+    Streaming version of Page.trim_view over (index, line) pairs: holds back
+    runs of blank lines until a non-blank line shows they aren't at the end
+    of the page. Yields nothing if every line is blank.
+    """
+    blanks = []
+    started = False
+    for i, line in lines:
+        if is_blank(line):
+            if started:
+                blanks.append((i, line))
+        else:
+            for blank in blanks:
+                yield blank
+            blanks = []
+            started = True
+            yield i, line
+
+def join_broken_lines(lines):
+    """
+    Streaming version of Page.remove_empties over (index, line) pairs,
+    looking two lines ahead.
+    """
+    end = object()
+    lines = iter(lines)
+    window = list(islice(lines, 3))
+    skip = False
+    while len(window) > 1:
+        line, following = window[0][1], window[1][1]
+        if skip:
+            skip = False
+        else:
+            # if the next line looks like it's breaking a sentence, skip it on next iteration
+            if len(window) > 2 and line != '' and following == '' and window[2][1] != '' and not line.endswith('.') and window[2][1][0].islower():
+                skip = True
+            if not (line == '' and following == ''): # eliminate chains of ''
+                yield window[0]
+        window.pop(0)
+        nextline = next(lines, end)
+        if nextline is not end:
+            window.append(nextline)
+    if window:
+        yield window[0]
@@ -0,0 +1,165 @@
+"""
+PageTriage.py
+Sorting rendered pages for Document.ocr before any of them are OCRed.
+Should contain:
+    read_pnm, which splits Ghostscript's stream of binary PNM pages
+    triage_page, which calls a low resolution page blank, image-only or text
+Notes:
+    Blank pages don't need tesseract at all, and an image-only page's few
+    words (a caption, a page number) aren't worth its slow second tier.
+    triage_page looks at a page in two steps: how much of it is inked, and
+    how much of that ink is in blobs the size and shape of letters and
+    words (see ink_components). At TRIAGE_DPI that is cheap next to
+    rendering the page for OCR, let alone reading it.
+    numpy is optional: without it PageTriage.numpy is None, read_pnm still
+    works, and Document OCRs every page without triage.
+"""
+import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def read_pnm(stream):
+    """
+    Read one binary PNM image (P4/P5/P6) off a stream of concatenated images,
+    as Ghostscript writes them for a multi-page document to stdout.
+
+    Args:
+        stream: binary file object
+
+    Returns: bytes of the complete image (header included), or None at EOF or
+    on a truncated image
+
+    """
+    header = b""
+    fields = []
+    token = b""
+    needed = 1
+    while len(fields) < needed:
+        c = stream.read(1)
+        if c == b"":
+            return None
+        header += c
+        if c == b"#" and token == b"":
+            # comment runs to end of line; ghostscript writes one after the magic
+            header += stream.readline()
+        elif c.isspace():
+            if token:
+                fields.append(token)
+                token = b""
+                # P4 bitmaps have no maxval field
+                needed = 3 if fields[0] == b"P4" else 4
+        else:
+            token += c
+    magic = fields[0]
+    width, height = int(fields[1]), int(fields[2])
+    if magic == b"P4":
+        size = ((width + 7) // 8) * height
+    else:
+        depth = 1 if int(fields[3]) < 256 else 2
+        size = width * height * depth * (3 if magic == b"P6" else 1)
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return header + data
+
+## Pages are rendered at TRIAGE_DPI and sorted by triage_page.
+## Blank pages have less than TRIAGE_BLANK_INK of the page (margins of
+## TRIAGE_MARGIN aside) inked. Image-only pages have fewer than
+## TRIAGE_MIN_TEXT_COMPONENTS text-sized ink blobs, and those hold less than
+## TRIAGE_TEXT_INK of the ink. Everything else is a text page.
+TRIAGE_DPI = 72
+TRIAGE_MARGIN = 0.05
+TRIAGE_BLANK_INK = 0.001
+TRIAGE_MIN_TEXT_COMPONENTS = 40
+TRIAGE_TEXT_INK = 0.3
+
+def pnm_pixels(image):
+    """
+    Returns: 2-d uint8 numpy array of a binary PGM image, as read_pnm returns
+    it; 16-bit images (maxval above 255) are scaled down to 8 bits
+    """
+    fields = re.match(rb"P5\s+(?:#[^\n]*\n\s*)*(\d+)\s+(?:#[^\n]*\n\s*)*(\d+)\s+(?:#[^\n]*\n\s*)*(\d+)\s", image)
+    width, height, maxval = int(fields.group(1)), int(fields.group(2)), int(fields.group(3))
+    if maxval < 256:
+        return numpy.frombuffer(image, dtype=numpy.uint8, count=width * height, offset=fields.end()).reshape(height, width)
+    pixels = numpy.frombuffer(image, dtype=">u2", count=width * height, offset=fields.end()).reshape(height, width)
+    return (pixels.astype(numpy.uint32) * 255 // maxval).astype(numpy.uint8)
+
+def ink_components(ink):
+    """
+    Label the 8-connected components of a boolean image by joining up the
+    runs of ink on neighbouring rows.
+
+    Returns: (heights, widths, areas) numpy arrays, one entry per component
+    """
+    height, width = ink.shape
+    padded = numpy.zeros((height, width + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = ink
+    edges = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(edges == 1)
+    ends = numpy.nonzero(edges == -1)[1]
+    row_first = numpy.searchsorted(rows, numpy.arange(height + 1)).tolist()
+    start_list, end_list = starts.tolist(), ends.tolist()
+    parent = list(range(len(start_list)))
+
+    def find(run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    for row in range(1, height):
+        above, end_above = row_first[row - 1], row_first[row]
+        here, end_here = end_above, row_first[row + 1]
+        while above < end_above and here < end_here:
+            # touching diagonally counts, hence <= and >=
+            if start_list[here] <= end_list[above] and end_list[here] >= start_list[above]:
+                root_above, root_here = find(above), find(here)
+                if root_above != root_here:
+                    parent[root_here] = root_above
+            if end_list[above] < end_list[here]:
+                above += 1
+            else:
+                here += 1
+    if not parent:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty
+    _, labels = numpy.unique([find(run) for run in range(len(parent))], return_inverse=True)
+    count = labels.max() + 1
+    top = numpy.full(count, height, dtype=numpy.int64)
+    bottom = numpy.zeros(count, dtype=numpy.int64)
+    left = numpy.full(count, width, dtype=numpy.int64)
+    right = numpy.zeros(count, dtype=numpy.int64)
+    areas = numpy.zeros(count, dtype=numpy.int64)
+    numpy.minimum.at(top, labels, rows)
+    numpy.maximum.at(bottom, labels, rows)
+    numpy.minimum.at(left, labels, starts)
+    numpy.maximum.at(right, labels, ends)
+    numpy.add.at(areas, labels, ends - starts)
+    return bottom - top + 1, right - left, areas
+
+def triage_page(image, dpi=TRIAGE_DPI):
+    """
+    Args:
+        image (bytes): the page as an 8-bit PGM, rendered at dpi
+        dpi (int): resolution of image
+
+    Returns: "blank", "image" or "text"
+    """
+    pixels = pnm_pixels(image)
+    height, width = pixels.shape
+    margin_y, margin_x = int(height * TRIAGE_MARGIN), int(width * TRIAGE_MARGIN)
+    pixels = pixels[margin_y:height - margin_y, margin_x:width - margin_x]
+    # ink is anything clearly darker than the paper, which needn't be white
+    ink = pixels < 0.75 * numpy.median(pixels)
+    if ink.mean() < TRIAGE_BLANK_INK:
+        return "blank"
+    heights, widths, areas = ink_components(ink)
+    # words and letters: no taller than a large heading, no wider than a
+    # long word, and not just an outline
+    text = (heights <= 0.3 * dpi) & (widths <= 2 * dpi) & (areas * 5 >= heights * widths)
+    if text.sum() >= TRIAGE_MIN_TEXT_COMPONENTS or areas[text].sum() >= TRIAGE_TEXT_INK * areas.sum():
+        return "text"
+    return "image"
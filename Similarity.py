@@ -0,0 +1,137 @@
+"""
+Similarity.py
+Fuzzy string comparison for header/footer detection in GeoDeepDive.
+Should contain:
+    Engines that answer "is SequenceMatcher(None, a, b).ratio() > cutoff?"
+    PhraseIndex, for checking many lines against a fixed set of phrases
+Notes:
+    find_headers and Page.cleanup compare a great many short lines, and almost
+    all of those pairs are nowhere near the cutoff. FastEngine rejects those
+    with cheap upper bounds on the ratio and only builds a SequenceMatcher for
+    the pairs that survive, so it makes exactly the same decisions as
+    SequenceMatcherEngine:
+        length bound: ratio <= 2 * min(len(a), len(b)) / (len(a) + len(b))
+            (this is SequenceMatcher.real_quick_ratio)
+        LCS bound: ratio <= 2 * LCS(a, b) / (len(a) + len(b)), since the
+            matching blocks SequenceMatcher finds are a common subsequence.
+            LCS comes from a bit-parallel edit distance (Hyyro 2004),
+            which is a handful of integer operations per character.
+"""
+from difflib import SequenceMatcher
+from bisect import bisect_left, bisect_right
+
+def lcs_length(a, b):
+    """
+    Length of the longest common subsequence of a and b, computed
+    bit-parallel: bit i of the row vector tracks column i of the LCS table.
+    """
+    if not a or not b:
+        return 0
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    row = full
+    for c in b:
+        matches = row & masks.get(c, 0)
+        row = ((row + matches) | (row - matches)) & full
+    return len(a) - bin(row).count("1")
+
+class SequenceMatcherEngine(object):
+
+    """Reference engine: difflib's ratio for every pair."""
+
+    def __init__(self):
+        self.stats = {"compared" : 0, "exact" : 0}
+
+    def ratio(self, a, b):
+        return SequenceMatcher(None, a, b).ratio()
+
+    def similar(self, a, b, cutoff):
+        """
+        Returns: True if SequenceMatcher(None, a, b).ratio() > cutoff
+        """
+        self.stats["compared"] += 1
+        self.stats["exact"] += 1
+        return self.ratio(a, b) > cutoff
+
+class FastEngine(SequenceMatcherEngine):
+
+    """Same decisions as SequenceMatcherEngine, with cheap rejections first."""
+
+    def __init__(self):
+        self.stats = {"compared" : 0, "pruned_length" : 0, "pruned_lcs" : 0, "exact" : 0}
+
+    def similar(self, a, b, cutoff):
+        self.stats["compared"] += 1
+        total = len(a) + len(b)
+        if total == 0:
+            # difflib calls two empty strings identical
+            return 1.0 > cutoff
+        if 2.0 * min(len(a), len(b)) / total <= cutoff:
+            self.stats["pruned_length"] += 1
+            return False
+        if 2.0 * lcs_length(a, b) / total <= cutoff:
+            self.stats["pruned_lcs"] += 1
+            return False
+        self.stats["exact"] += 1
+        return self.ratio(a, b) > cutoff
+
+class PhraseIndex(object):
+
+    """
+    A fixed set of phrases (the document's repeated headers/footers) that
+    lines get checked against. Phrases are sorted by length, so a lookup only
+    visits the length window that can possibly reach the cutoff, and each
+    phrase keeps its character histogram, which bounds the ratio the same
+    way SequenceMatcher.quick_ratio does. Whatever survives both goes to the
+    engine.
+    """
+
+    def __init__(self, phrases, engine):
+        self.engine = engine
+        self.phrases = sorted((str(phrase) for phrase in phrases), key=len)
+        self.lengths = [len(phrase) for phrase in self.phrases]
+        self.histograms = [char_histogram(phrase) for phrase in self.phrases]
+        self.stats = {"queries" : 0, "pruned_length" : 0, "pruned_histogram" : 0, "compared" : 0, "matched" : 0}
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def matches(self, line, cutoff):
+        """
+        Returns: True if any phrase p has SequenceMatcher(None, p, line).ratio() > cutoff
+        """
+        self.stats["queries"] += 1
+        n = len(line)
+        # 2 * min(m, n) / (m + n) > cutoff  <=>  n * c / (2 - c) < m < n * (2 - c) / c
+        if n == 0:
+            # difflib calls two empty strings identical
+            low, high = 0, bisect_right(self.lengths, 0)
+        else:
+            low = bisect_right(self.lengths, n * cutoff / (2 - cutoff))
+            high = bisect_left(self.lengths, n * (2 - cutoff) / cutoff) if cutoff > 0 else len(self.lengths)
+        self.stats["pruned_length"] += len(self.phrases) - max(0, high - low)
+        if high <= low:
+            return False
+        line_histogram = char_histogram(line)
+        for i in range(low, high):
+            m = self.lengths[i]
+            if m + n == 0:
+                common = 0
+            else:
+                common = sum(min(count, line_histogram.get(c, 0)) for c, count in self.histograms[i].items())
+                if 2.0 * common / (m + n) <= cutoff:
+                    self.stats["pruned_histogram"] += 1
+                    continue
+            self.stats["compared"] += 1
+            if self.engine.similar(self.phrases[i], line, cutoff):
+                self.stats["matched"] += 1
+                return True
+        return False
+
+def char_histogram(astring):
+    histogram = {}
+    for c in astring:
+        histogram[c] = histogram.get(c, 0) + 1
+    return histogram
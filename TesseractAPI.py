@@ -0,0 +1,249 @@
+"""
+TesseractAPI.py
+In-process tesseract for Document.ocr, through the C API in libtesseract.
+Should contain:
+    TesseractAPI, an OCR engine with the same recognize() as
+        Document.SubprocessEngine
+    get_engine, which shares one TesseractAPI per set of arguments
+Notes:
+    Every run of the tesseract binary loads eng.traineddata again, and on
+    short pages that load is a good share of the page's time. A TessBaseAPI
+    handle loads it once. Handles aren't thread-safe, so each page borrows an
+    idle one (creating it the first time there isn't one) and hands it back;
+    the handles live as long as the process, so later pages never load the
+    model again, and neither do later documents in the same process (batch
+    workers go on from one document to the next). ctypes releases the GIL
+    around the calls, so OCR threads really do run side by side.
+    A crash inside libtesseract takes the whole process down, not just the
+    page. In a batch run that is one worker: run_batch starts a new pool,
+    runs the documents that were in flight again one at a time, and records
+    the one that crashes. With a single process, --ocr-engine subprocess
+    keeps each page in a process of its own.
+    Only the options the tesseract command line gets from Document are
+    understood (-l, --oem, --psm and -c name=value); anything else means
+    get_engine returns None and the caller runs the binary instead.
+    The .txt file written is what the command line writes for the page,
+    page separator included (see page_separator). The .hocr has the same
+    body, but its head is HOCR_HEADER rather than the command line's, whose
+    meta tags vary with the version and options, and the page's image name
+    is left empty.
+"""
+import ctypes
+import ctypes.util
+import os
+import re
+import shlex
+import threading
+
+HOCR_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+ <head>
+  <title></title>
+  <meta http-equiv="Content-Type" content="text/html;charset=utf-8" />
+  <meta name='ocr-system' content='tesseract %s' />
+  <meta name='ocr-capabilities' content='ocr_page ocr_carea ocr_par ocr_line ocrx_word'/>
+ </head>
+ <body>
+"""
+HOCR_FOOTER = """ </body>
+</html>
+"""
+
+# default page segmentation mode of the tesseract command line
+PSM_AUTO = 3
+
+libraries = None
+engines = {}
+engines_lock = threading.Lock()
+
+def load_libraries():
+    """
+    Returns: (libtesseract, liblept) with argument types set, or None if
+    either can't be found
+    """
+    global libraries
+    if libraries is not None:
+        return libraries or None
+    libraries = ()
+    tesseract_name = ctypes.util.find_library("tesseract")
+    lept_name = ctypes.util.find_library("lept")
+    if tesseract_name is None or lept_name is None:
+        return None
+    try:
+        tess = ctypes.CDLL(tesseract_name)
+        lept = ctypes.CDLL(lept_name)
+    except OSError as ex:
+        print("ERROR\tCould not load libtesseract: %s" % ex)
+        return None
+
+    handle = ctypes.c_void_p
+    tess.TessVersion.restype = ctypes.c_char_p
+    tess.TessBaseAPICreate.restype = handle
+    tess.TessBaseAPIInit2.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    tess.TessBaseAPISetVariable.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p]
+    tess.TessBaseAPISetPageSegMode.argtypes = [handle, ctypes.c_int]
+    tess.TessBaseAPISetImage2.argtypes = [handle, ctypes.c_void_p]
+    tess.TessBaseAPIRecognize.argtypes = [handle, ctypes.c_void_p]
+    tess.TessBaseAPIGetUTF8Text.argtypes = [handle]
+    tess.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+    tess.TessBaseAPIGetHOCRText.argtypes = [handle, ctypes.c_int]
+    tess.TessBaseAPIGetHOCRText.restype = ctypes.c_void_p
+    tess.TessDeleteText.argtypes = [ctypes.c_void_p]
+    tess.TessBaseAPIClear.argtypes = [handle]
+    tess.TessBaseAPIDelete.argtypes = [handle]
+    lept.pixRead.argtypes = [ctypes.c_char_p]
+    lept.pixRead.restype = ctypes.c_void_p
+    lept.pixReadMem.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+    lept.pixReadMem.restype = ctypes.c_void_p
+    lept.pixDestroy.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+    libraries = (tess, lept)
+    return libraries
+
+def parse_args(tesseract_args):
+    """
+    Returns: (language, oem, psm, {variable : value}) for a tesseract
+    argument string, or None if it has options the API path doesn't handle
+    """
+    language, oem, psm, variables = "eng", 3, PSM_AUTO, {}
+    try:
+        words = shlex.split(tesseract_args)
+        while words:
+            option = words.pop(0)
+            if option == "-l":
+                language = words.pop(0)
+            elif option == "--oem":
+                oem = int(words.pop(0))
+            elif option == "--psm":
+                psm = int(words.pop(0))
+            elif option == "-c":
+                name, value = words.pop(0).split("=", 1)
+                variables[name] = value
+            else:
+                return None
+    except (IndexError, ValueError):
+        return None
+    return language, oem, psm, variables
+
+def page_separator(version, variables):
+    """
+    Returns: what the tesseract command line's text output puts after the
+    text of a one-page image: page_separator (a form feed unless -c sets
+    it) in tesseract 4; in 3 only with include_page_breaks, and in 5 never,
+    as it only goes between pages
+    """
+    separator = variables.get("page_separator", "\f")
+    major = re.match(r"v?(\d+)", version)
+    major = int(major.group(1)) if major is not None else 4
+    if major < 4:
+        return separator if variables.get("include_page_breaks", "0")[:1] in ("1", "T", "t", "Y", "y") else ""
+    if major == 4:
+        return separator
+    return ""
+
+def get_engine(tesseract_args, single_threaded=False):
+    """
+    Returns: the process's TesseractAPI for these arguments, or None if
+    libtesseract isn't installed or the arguments need the binary
+    """
+    settings = parse_args(tesseract_args)
+    if settings is None:
+        return None
+    if single_threaded:
+        # OpenMP reads this when libtesseract is loaded; pages in parallel
+        # threads would otherwise fight over the same cores
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    if load_libraries() is None:
+        return None
+    with engines_lock:
+        if tesseract_args not in engines:
+            engines[tesseract_args] = TesseractAPI(*settings)
+        return engines[tesseract_args]
+
+class TesseractAPI(object):
+
+    """Pool of initialised TessBaseAPI handles for one language/oem/psm/variables."""
+
+    def __init__(self, language, oem, psm, variables):
+        self.tess, self.lept = load_libraries()
+        self.language = language
+        self.oem = oem
+        self.psm = psm
+        self.variables = variables
+        self.version = self.tess.TessVersion().decode("ascii", "replace")
+        self.separator = page_separator(self.version, variables)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self):
+        """
+        Returns: an idle handle, or a new one, or None if tesseract won't initialise
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        handle = self.tess.TessBaseAPICreate()
+        if self.tess.TessBaseAPIInit2(handle, None, self.language.encode("utf-8"), self.oem) != 0:
+            print("ERROR\tCould not initialise tesseract for %s, oem %s" % (self.language, self.oem))
+            self.tess.TessBaseAPIDelete(handle)
+            return None
+        self.tess.TessBaseAPISetPageSegMode(handle, self.psm)
+        for name, value in self.variables.items():
+            self.tess.TessBaseAPISetVariable(handle, name.encode("utf-8"), value.encode("utf-8"))
+        with self.lock:
+            self.created += 1
+        return handle
+
+    def release(self, handle):
+        self.tess.TessBaseAPIClear(handle)
+        with self.lock:
+            self.idle.append(handle)
+
+    def read_text(self, pointer):
+        if not pointer:
+            return None
+        try:
+            return ctypes.string_at(pointer).decode("utf-8", "replace")
+        finally:
+            self.tess.TessDeleteText(pointer)
+
+    def recognize(self, image, out_base):
+        """
+        OCR one page, writing out_base.txt and out_base.hocr.
+
+        Args:
+            image (str or bytes): path to the rendered page, or the raster itself
+            out_base (str): output path minus extension
+
+        Returns: 0 on success, like the binary's exit status
+        """
+        if isinstance(image, bytes):
+            pix = self.lept.pixReadMem(image, len(image))
+        else:
+            pix = self.lept.pixRead(image.encode("utf-8"))
+        if not pix:
+            print("ERROR\tCould not read image for %s" % out_base)
+            return 1
+        pix = ctypes.c_void_p(pix)
+        handle = self.acquire()
+        if handle is None:
+            self.lept.pixDestroy(ctypes.byref(pix))
+            return 1
+        try:
+            self.tess.TessBaseAPISetImage2(handle, pix)
+            if self.tess.TessBaseAPIRecognize(handle, None) != 0:
+                return 1
+            text = self.read_text(self.tess.TessBaseAPIGetUTF8Text(handle))
+            hocr = self.read_text(self.tess.TessBaseAPIGetHOCRText(handle, 0))
+        finally:
+            self.release(handle)
+            self.lept.pixDestroy(ctypes.byref(pix))
+        if text is None or hocr is None:
+            return 1
+        with open(out_base + ".txt", "w", encoding="utf-8") as fout:
+            fout.write(text + self.separator)
+        with open(out_base + ".hocr", "w", encoding="utf-8") as fout:
+            fout.write(HOCR_HEADER % self.version + hocr + HOCR_FOOTER)
+        return 0
@@ -1,36 +1,167 @@
 import os
-
-def importrules(rulepath):
+import sys
+import marshal
+import threading
+from collections import OrderedDict
+
+from CompactTables import Lexicon, StringSet, StringMap, PairMap
+
+## Files under rulepath that importrules reads. The compiled snapshot (see
+## compile_rules) records their size and mtime and is rebuilt if any of
+## them change.
+RULEFILES = ('romannumerals.txt', 'MainDictionary.txt', 'PersonalNames.txt',
+             'CorrectionRules.txt', 'HyphenRules.txt', 'FusingRules.txt',
+             'SyncopeRules.txt')
+COMPILED = 'compiled_rules.marshal'
+COMPILED_FORMAT = 4
+
+## Tables compile_rules also writes out in CompactTables form, one file each
+## (see compact_path). With importrules(shared = True) they are mapped from
+## those files instead of being read into dicts, so every process on a node
+## shares one read-only copy of them. Lookups in a dict are about twice as
+## fast, so that is the default.
+COMPACT = (('lexicon', Lexicon), ('personalnames', StringSet),
+           ('correctionrules', StringMap), ('hyphenrules', StringMap),
+           ('syncoperules', StringMap), ('fuserules', PairMap))
+
+## How many distinct tokens (or token pairs) correct_stream remembers the
+## correction for, unless importrules is given another memo_size. Entries
+## are a few hundred bytes each.
+MEMO_SIZE = 50000
+
+## The following lines generate a translation map that zaps all
+## non-alphanumeric characters in a token.
+
+delchars = ''.join(c for c in map(chr, range(256)) if not c.isalpha())
+alleraser = str.maketrans('', '', delchars)
+
+## Translation map that only breaks selected punctuation marks
+## likely to pose a problem. Does not break hyphens, does break dashes.
+
+## Translation map that erases most punctuation, including hyphens.
+Punctuation = '.,():-—;"!?•$%@“”#<>+=/[]*^\'{}_■~\\|«»©&~`£·'
+mosteraser = str.maketrans('', '', Punctuation)
+
+punctuple = ('.', ',', '?', '!', ';', '"', '“', '”', ':', '--', '—', ')', "'", "(", "[", "]")
+
+delim = '\t'
+
+## The Corrector built by the last importrules call, which the module-level
+## as_stream/is_word/correct_stream functions use.
+corrector = None
+
+def importrules(rulepath, shared = False, memo_size = MEMO_SIZE, compiled_dir = None):
     '''
-    A function that creates global variables for the rest of this module
-    to use. Probably not the clearest data encapulation strategy in
-    the world. Wetware upgrades are expensive.
+    Loads the rulesets in rulepath into the module's default Corrector
+    (and, for older callers, module globals pointing at its tables).
+
+    Given a compiled_dir, the parsed tables come from the compiled snapshot
+    there (see compile_rules), which is much faster than parsing the text
+    files again; a missing or stale snapshot is rebuilt there first. Without
+    one, the text files are parsed every time and nothing is written. With
+    shared, the large tables are mapped read-only from the snapshot rather
+    than loaded, which costs a little per lookup but next to nothing per
+    process. memo_size is the number of tokens the Corrector's TokenMemo
+    holds (0 turns it off).
     '''
 
-    global delchars, alleraser, mosteraser, Punctuation, delim,\
-    foundcounter, englishcounter, pagedict, romannumerals, lexicon,\
-    personalnames, correctionrules, hyphenrules, syncoperules,\
-    fuserules, variants, punctuple\
-
-    ## The following lines generate a translation map that zaps all
-    ## non-alphanumeric characters in a token.
-
-    delchars = ''.join(c for c in map(chr, range(256)) if not c.isalpha())
-    alleraser = str.maketrans('', '', delchars)
-
-    ## Translation map that only breaks selected punctuation marks
-    ## likely to pose a problem. Does not break hyphens, does break dashes.
-
-    ## Translation map that erases most punctuation, including hyphens.
-    Punctuation = '.,():-—;"!?•$%@“”#<>+=/[]*^\'{}_■~\\|«»©&~`£·'
-    mosteraser = str.maketrans('', '', Punctuation)
+    global corrector, romannumerals, lexicon, personalnames,\
+    correctionrules, hyphenrules, syncoperules, fuserules, variants
+
+    corrector = Corrector.from_rulepath(rulepath, shared, memo_size, compiled_dir)
+
+    romannumerals = corrector.romannumerals
+    lexicon = corrector.lexicon
+    personalnames = corrector.personalnames
+    correctionrules = corrector.correctionrules
+    hyphenrules = corrector.hyphenrules
+    fuserules = corrector.fuserules
+    syncoperules = corrector.syncoperules
+    variants = corrector.variants
+
+def source_stamps(rulepath):
+    '''Size and mtime of every rule file, to tell whether a snapshot is stale.'''
+    stamps = dict()
+    for filename in RULEFILES:
+        info = os.stat(os.path.join(rulepath, filename))
+        stamps[filename] = (info.st_size, info.st_mtime_ns)
+    return stamps
+
+def compact_path(compiled_dir, name):
+    return os.path.join(compiled_dir, 'compiled_%s.bin' % name)
+
+def snapshot_header(rulepath, compiled_dir):
+    compact = dict()
+    for name, kind in COMPACT:
+        info = os.stat(compact_path(compiled_dir, name))
+        compact[name] = (info.st_size, info.st_mtime_ns)
+    return {'format': COMPILED_FORMAT, 'python': sys.version, 'sources': source_stamps(rulepath),
+            'compact': compact}
+
+def load_compiled(rulepath, shared = False, compiled_dir = None):
+    '''
+    Returns the rule tables from the compiled snapshot in compiled_dir
+    (rulepath if not given), or None if there isn't one or it no longer
+    matches the text files in rulepath (or was written by another Python,
+    since marshal's format isn't stable). With shared, every table in
+    COMPACT is mapped from its file.
+    '''
+    if compiled_dir is None:
+        compiled_dir = rulepath
+    compiled_path = os.path.join(compiled_dir, COMPILED)
+    try:
+        with open(compiled_path, 'rb') as file:
+            if marshal.load(file) != snapshot_header(rulepath, compiled_dir):
+                return None
+            tables = marshal.load(file)
+            if not shared:
+                # loads on one big read is several times faster than load on the file
+                tables.update(marshal.loads(file.read()))
+        for name, kind in COMPACT:
+            if shared:
+                tables[name] = kind.open(compact_path(compiled_dir, name))
+        return tables
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+def compile_rules(rulepath, compiled_dir = None):
+    '''
+    Parses the rule files in rulepath and writes the resulting tables to a
+    marshal snapshot (and CompactTables files) in compiled_dir (rulepath if
+    not given), so that importrules calls given that compiled_dir can skip
+    the parsing. Build it once, somewhere that outlasts a single job (shared
+    storage next to the MainDictionary.txt supplied at run time, say), as
+    soon as every rule file is in place:
 
-    punctuple = ('.', ',', '?', '!', ';', '"', '“', '”', ':', '--', '—', ')', "'", "(", "[", "]")
+        python3 Volume2.py /usr/bin/rulesets/ /path/to/compiled/
 
-    delim = '\t'
-    foundcounter = 0
-    englishcounter = 0
-    pagedict = dict()
+    Returns the parsed tables. A read-only compiled_dir just means no snapshot.
+    '''
+    if compiled_dir is None:
+        compiled_dir = rulepath
+    tables = parse_rules(rulepath)
+    compiled_path = os.path.join(compiled_dir, COMPILED)
+    tmp_path = compiled_path + '.tmp%d' % os.getpid()
+    try:
+        os.makedirs(compiled_dir, exist_ok = True)
+        # compact tables go first: the snapshot header records their stamps
+        for name, kind in COMPACT:
+            kind.save(tables[name], compact_path(compiled_dir, name))
+        # small tables, then the dict forms of the compact ones, which
+        # load_compiled skips in shared mode
+        small = dict((name, tables[name]) for name in ('romannumerals', 'variants'))
+        large = dict((name, tables[name]) for name, kind in COMPACT)
+        with open(tmp_path, 'wb') as file:
+            marshal.dump(snapshot_header(rulepath, compiled_dir), file)
+            marshal.dump(small, file)
+            marshal.dump(large, file)
+        os.replace(tmp_path, compiled_path)
+    except (OSError, ValueError) as e:
+        print('Could not write compiled rules to %s: %s' % (compiled_path, e))
+    return tables
+
+def parse_rules(rulepath):
+    '''Reads the text rule files into the tables a Corrector is built from.'''
 
     romannumerals = set()
     with open(os.path.join(rulepath, 'romannumerals.txt'), encoding = 'utf-8') as file:
@@ -132,119 +263,12 @@ def importrules(rulepath):
 
     ## End loading of rulesets.
 
-def as_stream(linelist, verbose = False):
-    '''converts a list of lines to a list of tokens'''
-    global lexicon, mosteraser
-
-    tokens = list()
-    for line in linelist:
-        if len(line) < 1:
-            continue
-        if line == "\n":
-            tokens.append(line)
-            continue
-        line = line.rstrip()
-        if line.startswith('<') and line.endswith('>'):
-            tokens.append(line)
-            tokens.append('\n')
-            continue
-
-        line = line.replace('”', '” ')
-        line = line.replace('“', ' “')
-        line = line.replace(':', ': ')
-        line = line.replace(';', '; ')
-        line = line.replace(',"', '«!!»')
-        line = line.replace(',', ', ')
-        line = line.replace('—', ' — ')
-        line = line.replace('--', ' -- ')
-        line = line.replace('«!!»', ',"')
-        ## Instead of zapping punctuation, we make sure it's followed by a space.
-        ## The bit about «!!» is a crude hack intended to avoid separating quotation marks
-        ## from a trailing comma
-
-        ## Quotes require special treatment, because their position relative to
-        ## the space can be significant.
-
-##        if '"' in line:
-##            nextindex = line.find('"')
-##            while nextindex >= 0:
-##                if nextindex >= (len(line) - 1):
-##                    followedbyspace = True
-##                    nextindex = -1
-##                elif line[nextindex+1] == " ":
-##                    followedbyspace = True
-##                    nextindex = line.find('"', nextindex+1, len(line))
-##                else:
-##                    if nextindex > 0 and line[nextindex - 1] == " ":
-##                        line = line[0:nextindex] + '“ ' + line[nextindex+1:]
-##                        nextindex = line.find('"', nextindex+2, len(line))
-##                        ## Okay, this is a teensy bit baroque. I know that correct_stream
-##                        ## doesn't handle prefixed punctuation very well. So I don't want
-##                        ## quotes to be prefixed to words. But I want to preserve the fact
-##                        ## that they were opening quotes. So I use the special open-quote
-##                        ## character if quote was prefixed to a word, and preceded by
-##                        ## a space.
-##
-##                    elif nextindex == 0:
-##                        line = '“' + line[nextindex+1:]
-##                        nextindex = line.find('"', nextindex+2, len(line))
-##                    else:
-##                        line = line[0:nextindex] + '" ' + line[nextindex+1:]
-##                        nextindex = line.find('"', nextindex+2, len(line))
-##                        ## If not preceded by a space, this is ambiguous, and I leave
-##                        ## the character ambiguous.
-
-
-        lineparts = line.split()
-        tokens.extend(lineparts)
-        tokens.append('\n')
-
-    counter = 0
-    englishcounter = 0
-    allcounter = 0
-
-    tokencount = len(tokens)
-
-    for i in range(0, tokencount):
-        token = tokens[i].lower()
-        if token in lexicon:
-            counter += 1
-            allcounter += 1
-            if lexicon[token] > 0:
-                englishcounter += 1
-        elif token == '\n' or token.startswith('<') or mostly_numeric(token):
-            next
-        elif i < (tokencount-1):
-            token = token.translate(mosteraser)
-            if token in lexicon:
-                counter += 1
-                allcounter += 1
-                if lexicon[token] > 0:
-                    englishcounter += 1
-            else:
-                nexttoken = tokens[i+1].lower()
-                fused = token + nexttoken.translate(mosteraser)
-                if fused in lexicon:
-                    counter += 1
-                    allcounter += 1
-                    if lexicon[fused] > 0:
-                        englishcounter += 1
-                else:
-                    allcounter += 1
-        else:
-            allcounter += 1
-
-    if allcounter > 0:
-        percentfound = counter / allcounter
-        percentenglish = englishcounter / allcounter
-    else:
-        percentfound = 0
-        percentenglish = 0
-
-    return tokens, percentfound, percentenglish
+    return {'romannumerals': romannumerals, 'lexicon': lexicon,
+            'personalnames': personalnames, 'correctionrules': correctionrules,
+            'hyphenrules': hyphenrules, 'fuserules': fuserules,
+            'syncoperules': syncoperules, 'variants': variants}
 
 def strip_punctuation(astring):
-    global punctuple
     keepclipping = True
     suffix = ""
     while keepclipping == True:
@@ -311,130 +335,294 @@ def is_punctuation(astring):
 
     return ispunct
 
-def is_word(astring):
-    global lexicon
-    if astring in lexicon:
-        return True
-    elif astring.lower() in lexicon:
-        return True
-    elif (astring.lower() + "'s") in lexicon:
-        return True
-    else:
+def is_word_token(token):
+    '''True for the tokens correct_stream treats as words (not linebreaks, markup or punctuation).'''
+    if token == '\n' or (token.startswith('<') and token.endswith('>')):
         return False
+    return len(token) > 0 and not is_punctuation(token)
 
-def logandreset(astring, caseflag, possessive, prefix, suffix):
-    ''' We normalize case at moments in the checking process, and
-    also remove trailing apostrophe-s and punctuation. This routine ensures that
-    both aspects of the token are restored to their original condition.
-    Note that it does so only after logging the word, which means that
-    possessive inflections are not registered in our wordcount.
-    That's my only gesture toward lemmatization.'''
-
-    global pagedict, lexicon, syncoperules, variants, foundcounter, englishcounter
+def last_word_index(tokens):
+    for i in range(len(tokens) - 1, -1, -1):
+        if is_word_token(tokens[i]):
+            return i
+    return None
 
+def first_word_index(tokens):
+    for i, token in enumerate(tokens):
+        if is_word_token(token):
+            return i
+    return None
 
-    if astring in syncoperules:
-        astring = syncoperules[astring]
-    if astring in variants:
-        astring = variants[astring]
+def count_words(tokens):
+    return sum(1 for token in tokens if is_word_token(token))
 
-    inDict = False
+def tokenize(linelist):
+    '''
+    Splits a list of lines into tokens: the first half of as_stream, for
+    callers that don't need its lexicon scores. Blank lines become '\n'
+    tokens and markup lines are kept whole.
+    '''
+    tokens = list()
+    for line in linelist:
+        if len(line) < 1:
+            continue
+        if line == "\n":
+            tokens.append(line)
+            continue
+        line = line.rstrip()
+        if line.startswith('<') and line.endswith('>'):
+            tokens.append(line)
+            tokens.append('\n')
+            continue
 
-    if astring in lexicon:
-        foundcounter += 1
-        inDict = True
-        if lexicon[astring] == 1:
-            englishcounter += 1
-    elif astring == "romannumeral" or astring == "arabicnumeral":
-        foundcounter += 1
-        englishcounter += 1
+        line = line.replace('”', '” ')
+        line = line.replace('“', ' “')
+        line = line.replace(':', ': ')
+        line = line.replace(';', '; ')
+        line = line.replace(',"', '«!!»')
+        line = line.replace(',', ', ')
+        line = line.replace('—', ' — ')
+        line = line.replace('--', ' -- ')
+        line = line.replace('«!!»', ',"')
+        ## Instead of zapping punctuation, we make sure it's followed by a space.
+        ## The bit about «!!» is a crude hack intended to avoid separating quotation marks
+        ## from a trailing comma. Nine C-level replaces are quicker here than one
+        ## regex pass with a callback, since most lines only have a few marks.
 
-    if inDict or astring == "romannumeral" or astring == "arabicnumeral":
+        tokens.extend(line.split())
+        tokens.append('\n')
 
-        if astring.lower() in pagedict:
-            pagedict[astring.lower()] += 1
-        else:
-            pagedict[astring.lower()] = 1
-
-    if caseflag == "lower":
-        astring = astring.lower()
-    elif caseflag == "upper":
-        astring = astring.upper()
-    elif caseflag == "title":
-        astring = astring[0].upper() + astring[1:].lower()
-        # I don't use "astring.title()" because You'Ll.
-    else:
-        astring = astring.lower()
+    return tokens
 
-    if possessive:
-        astring = astring + "'s"
+class StreamState(object):
+    '''Counters and page dictionary for a single correct_stream call.'''
 
-    if len(suffix) > 0:
-        astring = astring + suffix
+    def __init__(self):
+        self.pagedict = dict()
+        self.foundcounter = 0
+        self.englishcounter = 0
 
-    if len(prefix) > 0:
-        astring = prefix + astring
+class TokenMemo(object):
+    '''
+    Bounded LRU map from a token, or a (token, next token) pair, to what
+    correct_stream did with it. Most of a volume is the same few thousand
+    words, so most tokens skip the correction chain entirely. A maxsize of
+    0 turns it off.
+    '''
 
-    return astring
+    def __init__(self, maxsize = MEMO_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits" : 0, "misses" : 0, "evicted" : 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token, nexttoken):
+        '''Entry stored for token alone, else for (token, nexttoken), else None.'''
+        with self.lock:
+            for key in (token, (token, nexttoken)):
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, entry):
+        if self.maxsize < 1:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+                self.stats["evicted"] += 1
+
+class Corrector(object):
+    '''
+    A loaded set of rules plus the tokenizing/correcting functions that use
+    them. The rule tables are only read after __init__, and everything a
+    call accumulates lives in a StreamState local to that call, so a single
+    Corrector can be shared by a pool of threads, and several rule sets can
+    live side by side in one process. The one shared piece, the TokenMemo of
+    past corrections, locks around its own updates.
+    '''
 
+    def __init__(self, tables, memo_size = MEMO_SIZE):
+        self.romannumerals = frozenset(tables['romannumerals'])
+        self.lexicon = tables['lexicon']
+        self.personalnames = tables['personalnames']
+        if isinstance(self.personalnames, set):
+            self.personalnames = frozenset(self.personalnames)
+        self.correctionrules = tables['correctionrules']
+        self.hyphenrules = tables['hyphenrules']
+        self.fuserules = tables['fuserules']
+        self.syncoperules = tables['syncoperules']
+        self.variants = tables['variants']
+        # words that begin a fuse rule, the only ones whose correction can
+        # depend on the word after them once they're known to be words
+        self.fusefirsts = frozenset(pair[0] for pair in self.fuserules)
+        self.memo = TokenMemo(memo_size)
+
+    @classmethod
+    def from_rulepath(cls, rulepath, shared = False, memo_size = MEMO_SIZE, compiled_dir = None):
+        '''
+        A Corrector for the rules in rulepath; see importrules for the
+        arguments.
+        '''
+        if compiled_dir is None:
+            tables = parse_rules(rulepath)
+            mapped = None
+        else:
+            tables = load_compiled(rulepath, shared, compiled_dir)
+            if tables is not None:
+                return cls(tables, memo_size)
+            tables = compile_rules(rulepath, compiled_dir)
+            mapped = load_compiled(rulepath, shared, compiled_dir) if shared else None
+        if shared:
+            if mapped is not None:
+                tables = mapped
+            else:
+                # nothing to map (no compiled_dir, or a read-only one), but
+                # compact tables in memory still stay shared after a fork
+                for name, kind in COMPACT:
+                    try:
+                        tables[name] = kind.from_table(tables[name])
+                    except ValueError:
+                        pass # an English flag outside 0-255; keep the dict
+        return cls(tables, memo_size)
+
+    def as_stream(self, linelist, verbose = False):
+        '''converts a list of lines to a list of tokens'''
+
+        tokens = tokenize(linelist)
+
+        counter = 0
+        englishcounter = 0
+        allcounter = 0
+
+        lexicon = self.lexicon
+        lastindex = len(tokens) - 1
+
+        for i, token in enumerate(tokens):
+            token = token.lower()
+            flag = lexicon.get(token)
+            if flag is not None:
+                counter += 1
+                allcounter += 1
+                if flag > 0:
+                    englishcounter += 1
+            elif token == '\n' or token.startswith('<') or mostly_numeric(token):
+                pass
+            elif i < lastindex:
+                token = token.translate(mosteraser)
+                flag = lexicon.get(token)
+                if flag is not None:
+                    counter += 1
+                    allcounter += 1
+                    if flag > 0:
+                        englishcounter += 1
+                else:
+                    nexttoken = tokens[i+1].lower()
+                    fused = token + nexttoken.translate(mosteraser)
+                    flag = lexicon.get(fused)
+                    if flag is not None:
+                        counter += 1
+                        allcounter += 1
+                        if flag > 0:
+                            englishcounter += 1
+                    else:
+                        allcounter += 1
+            else:
+                allcounter += 1
 
-def correct_stream(tokens, verbose = False):
-    global lexicon, hyphenrules, fuserules, syncoperules, correctionrules, romannumerals, pagedict, foundcounter, englishcounter, personalnames
-
-    corrected = list()
-    streamlen = len(tokens)
-    skipflag = False
-    wordsfused = 0
-    pagecounter = 0
-    pagedict = dict()
-    pages = list()
-    foundcounter = 0
-    englishcounter = 0
-    paratext = 0
-
-    for i in range(0, streamlen):
-
-        thisword = tokens[i]
-        if len(thisword) < 1:
-            continue
+        if allcounter > 0:
+            percentfound = counter / allcounter
+            percentenglish = englishcounter / allcounter
+        else:
+            percentfound = 0
+            percentenglish = 0
+
+        return tokens, percentfound, percentenglish
+
+    def is_word(self, astring):
+        if astring in self.lexicon:
+            return True
+        elif astring.lower() in self.lexicon:
+            return True
+        elif (astring.lower() + "'s") in self.lexicon:
+            return True
+        else:
+            return False
+
+    def logandreset(self, state, astring, caseflag, possessive, prefix, suffix):
+        ''' We normalize case at moments in the checking process, and
+        also remove trailing apostrophe-s and punctuation. This routine ensures that
+        both aspects of the token are restored to their original condition.
+        Note that it does so only after logging the word, which means that
+        possessive inflections are not registered in our wordcount.
+        That's my only gesture toward lemmatization.'''
+
+        if astring in self.syncoperules:
+            astring = self.syncoperules[astring]
+        if astring in self.variants:
+            astring = self.variants[astring]
+
+        inDict = False
+        flag = self.lexicon.get(astring)
+
+        if flag is not None:
+            state.foundcounter += 1
+            inDict = True
+            if flag == 1:
+                state.englishcounter += 1
+        elif astring == "romannumeral" or astring == "arabicnumeral":
+            state.foundcounter += 1
+            state.englishcounter += 1
+
+        if inDict or astring == "romannumeral" or astring == "arabicnumeral":
+
+            if astring.lower() in state.pagedict:
+                state.pagedict[astring.lower()] += 1
+            else:
+                state.pagedict[astring.lower()] = 1
+
+        if caseflag == "lower":
+            astring = astring.lower()
+        elif caseflag == "upper":
+            astring = astring.upper()
+        elif caseflag == "title":
+            astring = astring[0].upper() + astring[1:].lower()
+            # I don't use "astring.title()" because You'Ll.
+        else:
+            astring = astring.lower()
 
-        originalword = thisword
+        if possessive:
+            astring = astring + "'s"
 
-        if thisword == "<pb>":
-            pages.append(pagedict)
-            pagedict = dict()
-            # log the old page dictionary and start a new one
-            corrected.append(thisword)
-            paratext +=1
-            continue
+        if len(suffix) > 0:
+            astring = astring + suffix
 
-        if (thisword.startswith('<') and thisword.endswith('>')) or thisword == '\n':
-            corrected.append(thisword)
-            paratext += 1
-            continue
+        if len(prefix) > 0:
+            astring = prefix + astring
 
-        if (is_punctuation(thisword)):
-            corrected.append(thisword)
-            continue
+        return astring
 
-        ## Notice the sequence here. We don't reset skipflag if we're just skipping newlines or
-        ## xml markup.
+    def correct_token(self, state, thisword, nextword):
+        '''
+        The decision chain correct_stream runs on each word, given the next
+        word in the stream. Counts and page dictionary entries go to state.
 
-        if skipflag:
-            skipflag = False
-            continue
+        Returns: the corrected tokens, whether nextword was fused into them
+        (and must be skipped), the number of words fused, and whether the
+        result would be the same whatever nextword was.
+        '''
 
-        # get the next word, ignoring newlines and xml markup
-        for j in range(1, 4):
-            if i < (streamlen-j):
-                nextword = tokens[i+j]
-                if nextword.startswith('<') or nextword=='\n':
-                    continue
-                else:
-                    break
-            else:
-                nextword = "#EOFile"
-                break
+        newtokens = list()
+        skip = False
+        fused = 0
 
         thisword, thiscase = normalize_case(thisword)
         nextword, nextcase = normalize_case(nextword)
@@ -462,80 +650,81 @@ def correct_stream(tokens, verbose = False):
 
         # Is this a number?
 
-        if thislower in romannumerals:
-            numeral = logandreset("romannumeral", thiscase, False, thisprefix, thissuffix)
-            corrected.append(thisword.upper())
-            continue
+        if thislower in self.romannumerals:
+            numeral = self.logandreset(state, "romannumeral", thiscase, False, thisprefix, thissuffix)
+            newtokens.append(thisword.upper())
+            return newtokens, skip, fused, True
 
         if mostly_numeric(thisword):
-            numeral = logandreset("arabicnumeral", thiscase, False, thisprefix, thissuffix)
-            corrected.append(thisprefix + thisword + thissuffix)
-            continue
+            numeral = self.logandreset(state, "arabicnumeral", thiscase, False, thisprefix, thissuffix)
+            newtokens.append(thisprefix + thisword + thissuffix)
+            return newtokens, skip, fused, True
 
-        if (thiscase=="title" or thiscase=="upper") and thisword in personalnames:
-            newtoken = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(newtoken)
-            continue
+        if (thiscase=="title" or thiscase=="upper") and thisword in self.personalnames:
+            newtoken = self.logandreset(state, thisword, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(newtoken)
+            return newtokens, skip, fused, True
 
         # Is this part of a phrase that needs fusing?
 
-        if is_word(thisword) and is_word(nextword):
+        if self.is_word(thisword) and self.is_word(nextword):
             fusetuple = (thislower, nextlower)
-            if fusetuple in fuserules:
+            if fusetuple in self.fuserules:
                 print("they're both words")
-                newtoken = fuserules[fusetuple]
-                newtoken = logandreset(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
-                corrected.append(newtoken)
-                wordsfused += 1
-                skipflag = True
-                continue
+                newtoken = self.fuserules[fusetuple]
+                newtoken = self.logandreset(state, newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
+                newtokens.append(newtoken)
+                fused = 1
+                skip = True
+                return newtokens, skip, fused, False
 
             else:
-                thisword = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-                corrected.append(thisword)
-                continue
+                thisword = self.logandreset(state, thisword, thiscase, thispossessive, thisprefix, thissuffix)
+                newtokens.append(thisword)
+                return newtokens, skip, fused, thislower not in self.fusefirsts
 
-        if is_word(thisword):
-            thisword = logandreset(thisword, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thisword)
-            continue
+        if self.is_word(thisword):
+            # nextword only matters if the two could have been fused
+            thisword = self.logandreset(state, thisword, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thisword)
+            return newtokens, skip, fused, thislower not in self.fusefirsts
 
-        ## At this point we know that thisword doesn't match lexicon. Maybe it's a word fragment
+        ## At this point we know that thisword doesn't match self.lexicon. Maybe it's a word fragment
         ## that needs to be joined to nextword, after erasure of hyphens, etc.
 
         thistrim = thisword.translate(mosteraser)
         nexttrim = nextword.translate(mosteraser)
         possiblefusion = thistrim + nexttrim
 
-        if is_word(possiblefusion):
+        if self.is_word(possiblefusion):
             print("possible fusion is word!")
-            newtoken = logandreset(possiblefusion, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
+            newtoken = self.logandreset(state, possiblefusion, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused = 1
+            skip = True
+            return newtokens, skip, fused, False
 
         #maybe both parts need to be corrected
-        if possiblefusion.lower() in correctionrules:
+        if possiblefusion.lower() in self.correctionrules:
             print("both parts corrected")
-            thiscorr = correctionrules[possiblefusion.lower()]
-            newtoken = logandreset(thiscorr, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
-
-        if thisword in correctionrules:
-            thiscorr = correctionrules[thisword]
-        elif thistrim in correctionrules:
-            thiscorr = correctionrules[thistrim]
+            thiscorr = self.correctionrules[possiblefusion.lower()]
+            newtoken = self.logandreset(state, thiscorr, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused = 1
+            skip = True
+            return newtokens, skip, fused, False
+
+        if thisword in self.correctionrules:
+            thiscorr = self.correctionrules[thisword]
+        elif thistrim in self.correctionrules:
+            thiscorr = self.correctionrules[thistrim]
         else:
             thiscorr = thisword.lower()
 
-        if nextword in correctionrules:
-            nextcorr = correctionrules[nextword]
-        elif nexttrim in correctionrules:
-            nextcorr = correctionrules[nexttrim]
+        if nextword in self.correctionrules:
+            nextcorr = self.correctionrules[nextword]
+        elif nexttrim in self.correctionrules:
+            nextcorr = self.correctionrules[nexttrim]
         else:
             nextcorr = nextword.lower()
 
@@ -545,27 +734,27 @@ def correct_stream(tokens, verbose = False):
         ## Now we have to check one last time for possible fusing.
 
         fusetuple = (thiscorr, nextcorr)
-        if fusetuple in fuserules:
+        if fusetuple in self.fuserules:
             print("checking one last time")
-            newtoken = fuserules[fusetuple]
-            newtoken = logandreset(newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
-            corrected.append(newtoken)
-            wordsfused += 1
-            skipflag = True
-            continue
+            newtoken = self.fuserules[fusetuple]
+            newtoken = self.logandreset(state, newtoken, thiscase, nextpossessive, thisprefix, nextsuffix)
+            newtokens.append(newtoken)
+            fused = 1
+            skip = True
+            return newtokens, skip, fused, False
 
         ## But otherwise, if the correction worked, move on.
 
-        if is_word(thiscorr):
-            thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+        if self.is_word(thiscorr):
+            thiscorr = self.logandreset(state, thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return newtokens, skip, fused, False
 
-        if thiscorr in hyphenrules:
-            thiscorr = hyphenrules[thiscorr]
+        if thiscorr in self.hyphenrules:
+            thiscorr = self.hyphenrules[thiscorr]
 
         ## Maybe the correction is multiple words. That's a split that could have happened as a result
-        ## of correctionrules or hyphenrules.
+        ## of self.correctionrules or self.hyphenrules.
 
         if " " in thiscorr:
             theseparts = thiscorr.split()
@@ -576,21 +765,21 @@ def correct_stream(tokens, verbose = False):
                 else:
                     partcase = "lower"
 
-                newtoken = logandreset(part, partcase, False, "", "")
+                newtoken = self.logandreset(state, part, partcase, False, "", "")
                 if j == (len(theseparts) - 1):
                     newtoken = newtoken + thissuffix
-                corrected.append(newtoken)
-            continue
+                newtokens.append(newtoken)
+            return newtokens, skip, fused, False
 
         ## Ordinary correction rules didn't work. Now we try syncope.
 
-        if thiscorr in syncoperules:
-            thiscorr = syncoperules[thiscorr]
+        if thiscorr in self.syncoperules:
+            thiscorr = self.syncoperules[thiscorr]
 
-        if is_word(thiscorr):
-            thiscorr = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+        if self.is_word(thiscorr):
+            thiscorr = self.logandreset(state, thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return newtokens, skip, fused, False
 
         ## If we still have a hyphen, try splitting there.
 
@@ -604,49 +793,181 @@ def correct_stream(tokens, verbose = False):
                 else:
                     partcase = "lower"
 
-                newtoken = logandreset(part, partcase, False, "", "")
+                newtoken = self.logandreset(state, part, partcase, False, "", "")
                 if j == (len(theseparts) - 1):
                     newtoken = newtoken + thissuffix
-                corrected.append(newtoken)
-            continue
+                newtokens.append(newtoken)
+            return newtokens, skip, fused, False
 
         #last-ditch move. zap all nonalphabetic characters
 
         thispurged = thiscorr.translate(alleraser)
 
-        if is_word(thispurged):
-            thiscorr = logandreset(thispurged, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(thiscorr)
-            continue
+        if self.is_word(thispurged):
+            thiscorr = self.logandreset(state, thispurged, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(thiscorr)
+            return newtokens, skip, fused, False
         else:
-            originalword = logandreset(thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
-            corrected.append(originalword)
+            originalword = self.logandreset(state, thiscorr, thiscase, thispossessive, thisprefix, thissuffix)
+            newtokens.append(originalword)
             ## The word will in fact only be logged in the page dictionary if it
             ## matches the dictionary. Variant spellings will be normalized in the
             ## logandreset function.
-            continue
+            return newtokens, skip, fused, False
 
-    if verbose:
-        print('There were', wordsfused, 'fused words.')
+    def correct_stream(self, tokens, verbose = False):
 
-    totaltokens = len(corrected) - paratext
-    if totaltokens > 0:
-        percentmatched = foundcounter / totaltokens
-        percentenglish = englishcounter / totaltokens
-    else:
-        percentmatched = 0
-        percentenglish = 0
-    return corrected, pages, percentmatched, percentenglish
+        corrected = list()
+        streamlen = len(tokens)
+        skipflag = False
+        wordsfused = 0
+        pagecounter = 0
+        state = StreamState()
+        pages = list()
+        paratext = 0
 
-    # The method returns a vector of all tokens, including xml tags and linebreaks,
-    # plus a list of page dictionaries, plus a count of words that matched, and the
-    # number of those words that were english.
+        for i in range(0, streamlen):
 
+            thisword = tokens[i]
+            if len(thisword) < 1:
+                continue
 
+            originalword = thisword
 
+            if thisword == "<pb>":
+                pages.append(state.pagedict)
+                state.pagedict = dict()
+                # log the old page dictionary and start a new one
+                corrected.append(thisword)
+                paratext +=1
+                continue
 
+            if (thisword.startswith('<') and thisword.endswith('>')) or thisword == '\n':
+                corrected.append(thisword)
+                paratext += 1
+                continue
 
+            if (is_punctuation(thisword)):
+                corrected.append(thisword)
+                continue
+
+            ## Notice the sequence here. We don't reset skipflag if we're just skipping newlines or
+            ## xml markup.
+
+            if skipflag:
+                skipflag = False
+                continue
 
+            # get the next word, ignoring newlines and xml markup
+            for j in range(1, 4):
+                if i < (streamlen-j):
+                    nextword = tokens[i+j]
+                    if nextword.startswith('<') or nextword=='\n':
+                        continue
+                    else:
+                        break
+                else:
+                    nextword = "#EOFile"
+                    break
 
+            if self.memo.maxsize < 1:
+                newtokens, skipflag, fused, _ = self.correct_token(state, thisword, nextword)
+                corrected.extend(newtokens)
+                wordsfused += fused
+                continue
+
+            entry = self.memo.get(thisword, nextword)
+            if entry is None:
+                # run the whole chain against a blank state, so that what it
+                # did to the counters can be replayed on later hits
+                scratch = StreamState()
+                newtokens, skip, fused, contextfree = self.correct_token(scratch, thisword, nextword)
+                entry = (tuple(newtokens), skip, fused, scratch.foundcounter,
+                         scratch.englishcounter, tuple(scratch.pagedict.items()))
+                if contextfree:
+                    self.memo.put(thisword, entry)
+                else:
+                    self.memo.put((thisword, nextword), entry)
+
+            newtokens, skip, fused, found, english, pagecounts = entry
+            corrected.extend(newtokens)
+            skipflag = skip
+            wordsfused += fused
+            state.foundcounter += found
+            state.englishcounter += english
+            for word, count in pagecounts:
+                state.pagedict[word] = state.pagedict.get(word, 0) + count
+
+        if verbose:
+            print('There were', wordsfused, 'fused words.')
+
+        totaltokens = len(corrected) - paratext
+        if totaltokens > 0:
+            percentmatched = state.foundcounter / totaltokens
+            percentenglish = state.englishcounter / totaltokens
+        else:
+            percentmatched = 0
+            percentenglish = 0
+        return corrected, pages, percentmatched, percentenglish
+
+        # The method returns a vector of all tokens, including xml tags and linebreaks,
+        # plus a list of page dictionaries, plus a count of words that matched, and the
+        # number of those words that were english.
+
+    def join_pages(self, pages):
+        '''
+        Concatenates pages that were corrected separately into one token
+        stream. Only the stretch from the last word of one page to the first
+        word of the next is corrected again, since that is the only place where
+        correcting page by page can miss something: a word hyphenated or
+        split across the page break. The window is kept only if correction
+        fused the two words.
+
+        This is close to, but not the same as, correcting the concatenated
+        pages again: a correction the whole-stream pass would have made
+        across a page break without fusing the two words (or one that
+        depends on which word comes first on the next page) is not made.
+
+        This is a generator, and pages can be any iterable: tokens are yielded
+        as soon as no later page can change them, so only the tail of the
+        previous page is ever held back.
+        '''
+        pending = list()
+        for page in pages:
+            last = last_word_index(pending)
+            first = first_word_index(page)
+            if last is None or first is None:
+                pending.extend(page)
+            else:
+                window = pending[last:] + page[:first + 1]
+                corrected, _, _, _ = self.correct_stream(window)
+                if count_words(corrected) < count_words(window):
+                    pending[last:] = corrected
+                else:
+                    pending.extend(page[:first + 1])
+                pending.extend(page[first + 1:])
+
+            last = last_word_index(pending)
+            if last is None:
+                last = len(pending)
+            for token in pending[:last]:
+                yield token
+            del pending[:last]
+        for token in pending:
+            yield token
+
+def as_stream(linelist, verbose = False):
+    '''converts a list of lines to a list of tokens, using the rules from importrules'''
+    return corrector.as_stream(linelist, verbose)
+
+def is_word(astring):
+    return corrector.is_word(astring)
+
+def correct_stream(tokens, verbose = False):
+    return corrector.correct_stream(tokens, verbose)
 
+def join_pages(pages):
+    return corrector.join_pages(pages)
 
+if __name__ == '__main__':
+    compile_rules(sys.argv[1] if len(sys.argv) > 1 else 'rulesets', sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+bench_render.py
+Compares render + OCR throughput of the profiles in Document.RENDER_PROFILES
+against the default (600 dpi png16m written to ocr_tmp/) settings.
+
+Meant to be run inside the container, like Document.py:
+
+    python3 benchmarks/bench_render.py some.pdf [profile ...]
+
+For each profile it reports wall time, pages per second, bytes written to
+ocr_tmp/ and the number of words tesseract produced, so a faster profile that
+quietly loses text is easy to spot.
+"""
+import sys
+import os
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from Document import Document, RENDER_PROFILES
+
+def dir_size(dirpath):
+    total = 0
+    for root, _, files in os.walk(dirpath):
+        for name in files:
+            total += path.getsize(path.join(root, name))
+    return total
+
+def run_profile(pdf_path, name):
+    """
+    OCR pdf_path with the named profile.
+
+    Returns: (seconds, pages, bytes written to ocr_tmp, words OCRed)
+    """
+    document = Document(pdf_path=pdf_path, working_dir="bench_%s" % name, render_profile=RENDER_PROFILES[name], cache_dir=None, use_text_layer=False, triage_pages=False)
+    start = time.time()
+    document.ocr()
+    elapsed = time.time() - start
+    words = 0
+    for filename in document.page_files:
+        with open(filename, encoding="utf-8") as fin:
+            words += len(fin.read().split())
+    return elapsed, len(document.page_files), dir_size(document.working_dir + "ocr_tmp"), words
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: %s some.pdf [profile ...]" % sys.argv[0])
+        print("Profiles: %s" % ", ".join(sorted(RENDER_PROFILES)))
+        sys.exit(1)
+    pdf_path = path.abspath(sys.argv[1])
+    names = sys.argv[2:] or sorted(RENDER_PROFILES)
+    if "default" in names:
+        names.remove("default")
+    names.insert(0, "default")
+
+    results = {}
+    for name in names:
+        results[name] = run_profile(pdf_path, name)
+
+    baseline = results["default"][0]
+    print("%-16s %9s %7s %9s %14s %9s" % ("profile", "seconds", "pages", "pages/s", "ocr_tmp bytes", "speedup"))
+    for name in names:
+        elapsed, pages, written, words = results[name]
+        print("%-16s %9.1f %7d %9.2f %14d %8.2fx  (%d words)" % (name, elapsed, pages, pages / elapsed if elapsed else 0, written, baseline / elapsed if elapsed else 0, words))
+
+if __name__ == '__main__':
+    main()
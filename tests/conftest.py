@@ -0,0 +1,25 @@
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from Similarity import FastEngine, PhraseIndex
+
+
+class FakeDocument(object):
+    """Just the parts of Document that Page needs."""
+
+    def __init__(self, n_pages, repeated_phrases):
+        self.expected_pagenumbers = [None] * n_pages
+        self.repeated_phrases = set(repeated_phrases)
+        self.phrase_index = PhraseIndex(self.repeated_phrases, FastEngine())
+
+    def get_phrase_index(self):
+        return self.phrase_index
+
+
+@pytest.fixture
+def fake_document():
+    """Makes FakeDocuments: fake_document(n_pages, repeated_phrases)."""
+    return FakeDocument
@@ -0,0 +1,85 @@
+import random
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from CompactTables import Lexicon, PairMap, StringMap, StringSet
+
+
+def random_word(rng):
+    # mostly ASCII, some accented and CJK letters, and now and then a lone
+    # surrogate of the kind a bad decode leaves behind
+    alphabet = "abcdefghij'-" + "éüßø" + "漢字" + "𐏿"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+
+
+def tables(rng, n_keys):
+    words = set(random_word(rng) for _ in range(n_keys)) | {"", "the", "Überschrift", "\udcff"}
+    words = sorted(words)
+    return {
+        Lexicon: dict((word, rng.randint(0, 255)) for word in words),
+        StringSet: set(words),
+        StringMap: dict((word, random_word(rng)) for word in words),
+        PairMap: dict(((word, rng.choice(words)), random_word(rng)) for word in words),
+    }
+
+
+def assert_answers_like(table, source):
+    assert len(table) == len(source)
+    assert sorted(table) == sorted(source)
+    for key in source:
+        assert key in table
+        if not isinstance(source, set):
+            assert table[key] == source[key]
+            assert table.get(key) == source[key]
+
+
+def test_tables_answer_like_their_source(tmp_path):
+    rng = random.Random(0)
+    for n_keys in (0, 1, 7, 500):
+        for kind, source in tables(rng, n_keys).items():
+            filepath = str(tmp_path / ("%s_%d.bin" % (kind.__name__, n_keys)))
+            kind.save(source, filepath)
+            for table in (kind.from_table(source), kind.open(filepath)):
+                assert_answers_like(table, source)
+
+
+def test_missing_keys():
+    rng = random.Random(1)
+    for kind, source in tables(rng, 200).items():
+        table = kind.from_table(source)
+        missing = [random_word(rng) for _ in range(200)] + ["the\x00the", "\udc80"]
+        if kind is PairMap:
+            missing = [(word, word) for word in missing] + [("the",), ("the", "the", "the"), "the"]
+        for key in missing:
+            if key in source:
+                continue
+            assert key not in table
+            if kind is StringSet:
+                continue
+            assert table.get(key) is None and table.get(key, "default") == "default"
+            with pytest.raises(KeyError):
+                table[key]
+
+
+def test_pair_map_keys_are_tuples():
+    source = {("every", "where"): "everywhere", ("half", "way"): "halfway", ("to", "day"): "today"}
+    table = PairMap.from_table(source)
+    assert sorted(table) == sorted(source)
+    assert all(isinstance(key, tuple) for key in table)
+    assert table[("half", "way")] == "halfway"
+    # joined keys never pass for tuples
+    assert "half\x00way" not in table and ("half way",) not in table
+
+
+def test_lexicon_flags_must_fit_in_a_byte():
+    assert Lexicon.from_table({"the": 255})["the"] == 255
+    with pytest.raises(ValueError):
+        Lexicon.build({"the": 1, "shale": 256})
+    with pytest.raises(ValueError):
+        Lexicon.from_table({"the": -1})
+    # the wrong kind of table is refused rather than misread
+    with pytest.raises(ValueError):
+        Lexicon(StringSet.build({"the"}))
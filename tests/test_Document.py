@@ -0,0 +1,220 @@
+import os
+import random
+import sys
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import Document
+import Volume2
+
+
+def brute_force_pagenumbers(potential_pagenumbers, cutoff=0.7):
+    # how find_headers accepted numbers before infer_pagenumbers
+    found = [None] * len(potential_pagenumbers)
+    observed = set(y for x in potential_pagenumbers for y in x)
+    for i, page in enumerate(potential_pagenumbers):
+        for pageno in page:
+            expected = set(range(pageno - i, pageno - i + len(potential_pagenumbers)))
+            if float(len(expected.intersection(observed))) / len(potential_pagenumbers) > cutoff:
+                found[i] = pageno
+    return found
+
+
+class NumberedDocument(object):
+    """Just the parts of Document that predict_pagenumbers needs."""
+
+    def __init__(self, potential_pagenumbers):
+        self.found_pagenumbers = [None] * len(potential_pagenumbers)
+        self.pagenumber_offset, self.pagenumber_confidence = Document.infer_pagenumbers(potential_pagenumbers, self.found_pagenumbers)
+        self.page_list = [type("FakePage", (object,), {})() for _ in potential_pagenumbers]
+        Document.Document.predict_pagenumbers(self)
+
+    def expected(self):
+        return [page.expected_page_no for page in self.page_list]
+
+
+def test_infer_pagenumbers_on_known_sequences():
+    # printed numbers 5..24, a few pages without one (plates, a blank) and
+    # stray numbers from figure captions and a year
+    potential = [[5 + i] for i in range(20)]
+    potential[0] = []
+    potential[7] = [3, 1987]
+    potential[8] = []
+    potential[13] = [18, 2]
+    document = NumberedDocument(potential)
+    assert document.pagenumber_offset == 5
+    assert document.found_pagenumbers == [None] + list(range(6, 12)) + [None, None] + list(range(14, 25))
+    assert document.pagenumber_confidence == 17.0 / 20
+    assert document.expected() == list(range(5, 25))
+
+    # an inserted run of plates numbered out of order with the text
+    potential = [[1 + i] for i in range(20)]
+    potential[9:12] = [[101], [103], [102]]
+    document = NumberedDocument(potential)
+    assert document.found_pagenumbers[9:12] == [None, None, None]
+    assert document.pagenumber_offset == 1
+    assert document.expected() == list(range(1, 21))
+
+    # numbering restarting halfway (two parts bound together) fits no
+    # single offset well enough, so nothing is accepted
+    document = NumberedDocument([[1 + i % 10] for i in range(20)])
+    assert document.found_pagenumbers == [None] * 20
+    assert (document.pagenumber_offset, document.pagenumber_confidence) == (None, 0.0)
+    assert document.expected() == [None] * 20
+
+
+def test_infer_pagenumbers_matches_brute_force():
+    rng = random.Random(2)
+    for trial in range(300):
+        n_pages = rng.randint(1, 40)
+        start = rng.randint(-3, 200)
+        potential = []
+        for i in range(n_pages):
+            numbers = []
+            if rng.random() < 0.8:
+                numbers.append(start + i)
+            if rng.random() < 0.2:
+                numbers.append(rng.randint(0, 300))
+            potential.append(numbers)
+        found = [None] * n_pages
+        Document.infer_pagenumbers(potential, found)
+        assert found == brute_force_pagenumbers(potential), potential
+
+RULES = {
+    "romannumerals.txt": "ii\niii\n",
+    "MainDictionary.txt": "the\t1\nshale\t1\nis\t1\nhard\t1\nsandstone\t1\n",
+    "PersonalNames.txt": "smith\n",
+    # the second rule only applies to what the first one produced
+    "CorrectionRules.txt": "tlie\tthc\nthc\tthe\n",
+    "HyphenRules.txt": "sand-stone\tsandstone\n",
+    "FusingRules.txt": "",
+    "SyncopeRules.txt": "",
+}
+
+
+def test_document_clean_is_corrected_twice(tmp_path):
+    for name, text in RULES.items():
+        (tmp_path / name).write_text(text, encoding="utf-8")
+    Volume2.importrules(str(tmp_path))
+
+    # what clean_document does with each page's lines
+    pages = [["tlie shale is hard and sand-\n"], ["stone is tlie shale\n"]]
+    corrected = [Document.correct_page(lines) for lines in pages]
+    with Document.TokenWriter(str(tmp_path / "page_1_clean.txt")) as fout:
+        fout.write(corrected[0][0])
+    with Document.TokenWriter(str(tmp_path / "document_clean.txt"), lasttoken="\n") as fout:
+        fout.write(Volume2.join_pages(document_tokens for _, document_tokens in corrected))
+
+    # page files get one pass, the document a second one, as they always
+    # have; the word split across the page break is joined up
+    assert (tmp_path / "page_1_clean.txt").read_text(encoding="utf-8") == "thc shale is hard and sand \n"
+    assert (tmp_path / "document_clean.txt").read_text(encoding="utf-8") == "the shale is hard and sandstone \nis the shale \n"
+
+
+def fake_process_document(document_path, rulepath, ocr_workers, ocr_slots=None, timeout=None, ocr_engine="auto"):
+    if "crash" in document_path:
+        os._exit(1)  # what a segfault in libtesseract looks like from outside
+    if "slow" in document_path:
+        time.sleep(0.2)
+    status = Document.document_status(document_path)
+    status["pages"] = os.getpid()
+    return status
+
+
+def test_run_batch_survives_a_worker_that_dies(monkeypatch):
+    # workers are forked from here, so they see the patched module
+    monkeypatch.setattr(Document, "process_document", fake_process_document)
+    monkeypatch.setattr(Volume2, "corrector", object())
+    monkeypatch.setattr(Document, "batch_settings", {"rulepath": None, "shared_rules": False, "memo_size": 0,
+                                                     "ocr_workers": 2, "timeout": None, "ocr_engine": "subprocess"})
+    paths = ["a.pdf", "slow_b.pdf", "crash_c.pdf", "d.pdf", "slow_e.pdf", "crash_f.pdf", "g.pdf"]
+    recorded = []
+    Document.run_batch(paths, 3, recorded.append)
+
+    statuses = dict((status["document"], status["status"]) for status in recorded)
+    assert sorted(status["document"] for status in recorded) == sorted(paths)  # each exactly once
+    assert statuses == dict((path, "crashed" if "crash" in path else "ok") for path in paths)
+    assert all(status["error"] == "worker process died" for status in recorded if status["status"] == "crashed")
+
+    # without crashes, workers go on from one document to the next
+    recorded = []
+    Document.run_batch(["%d.pdf" % n for n in range(8)], 2, recorded.append)
+    assert len(recorded) == 8 and len(set(status["pages"] for status in recorded)) <= 2
+
+
+class FakeEngine(object):
+    """Writes a page whose words all have the given confidence, or fails (None)."""
+
+    def __init__(self, name, confidence):
+        self.name = name
+        self.confidence = confidence
+        self.calls = 0
+
+    def recognize(self, image, out_base):
+        self.calls += 1
+        if self.confidence is None:
+            # a failed run can leave part of its output behind
+            with open(out_base + ".txt", "w") as fout:
+                fout.write("partial")
+            return 1
+        with open(out_base + ".txt", "w") as fout:
+            fout.write(self.name)
+        with open(out_base + ".hocr", "w") as fout:
+            fout.write("<span class='ocrx_word' title='bbox 0 0 9 9; x_wconf %d'>%s</span>" % (self.confidence, self.name))
+        return 0
+
+
+def tiered_document(tmp_path, *confidences):
+    # each tier's engine, and the binary it falls back on, give the same result
+    document = Document.Document.__new__(Document.Document)
+    document.working_dir = str(tmp_path) + "/"
+    document.engines = [(FakeEngine("tier %d" % (tier + 1), confidence), FakeEngine("binary %d" % (tier + 1), confidence))
+                        for tier, confidence in enumerate(confidences)]
+    document.tier_stats = [{"args": "", "pages": 0, "seconds": 0.0, "low_confidence": 0, "retry_failed": 0} for _ in confidences]
+    document.stats_lock = threading.Lock()
+    document.children = Document.ChildProcesses()
+    document.retry_confidence = 70
+    return document
+
+
+def ocr_output(tmp_path):
+    out_base = str(tmp_path / "page_1")
+    with open(out_base + ".txt") as fin:
+        return fin.read(), Document.hocr_confidence(out_base + ".hocr"), sorted(os.listdir(str(tmp_path)))
+
+
+def test_recognize_low_confidence_then_success(tmp_path):
+    document = tiered_document(tmp_path, 40, 90)
+    assert document.recognize("page.pnm", str(tmp_path / "page_1")) == 0
+    assert ocr_output(tmp_path) == ("tier 2", 90, ["page_1.hocr", "page_1.txt"])
+    assert [(stats["pages"], stats["low_confidence"]) for stats in document.tier_stats] == [(1, 1), (1, 0)]
+
+
+def test_recognize_low_confidence_then_failure_keeps_first_tier(tmp_path):
+    document = tiered_document(tmp_path, 40, None)
+    assert document.recognize("page.pnm", str(tmp_path / "page_1")) == 0
+    assert ocr_output(tmp_path) == ("tier 1", 40, ["page_1.hocr", "page_1.txt"])
+    assert document.engines[1][1].calls == 1  # the binary was tried too
+    assert document.tier_stats[1]["retry_failed"] == 1
+
+
+def test_recognize_failure_then_success(tmp_path):
+    document = tiered_document(tmp_path, None, 90)
+    assert document.recognize("page.pnm", str(tmp_path / "page_1")) == 0
+    assert ocr_output(tmp_path) == ("tier 2", 90, ["page_1.hocr", "page_1.txt"])
+    assert [stats["retry_failed"] for stats in document.tier_stats] == [0, 0]
+
+    # failing every tier fails the page
+    document = tiered_document(tmp_path, None, None)
+    assert document.recognize("page.pnm", str(tmp_path / "page_2")) != 0
+
+
+def test_recognize_max_tiers(tmp_path):
+    document = tiered_document(tmp_path, 40, 90)
+    assert document.recognize("page.pnm", str(tmp_path / "page_1"), max_tiers=1) == 0
+    assert ocr_output(tmp_path) == ("tier 1", 40, ["page_1.hocr", "page_1.txt"])
+    assert document.engines[1][0].calls == 0
+    # the last tier run isn't counted as low confidence: nothing comes after it
+    assert [(stats["pages"], stats["low_confidence"]) for stats in document.tier_stats] == [(1, 0), (0, 0)]
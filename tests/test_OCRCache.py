@@ -0,0 +1,108 @@
+import os
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from OCRCache import OCRCache
+
+
+def write_page(out_base, text, hocr):
+    with open(out_base + ".txt", "w", encoding="utf-8") as fout:
+        fout.write(text)
+    with open(out_base + ".hocr", "w", encoding="utf-8") as fout:
+        fout.write(hocr)
+
+
+def read(filepath):
+    with open(filepath, encoding="utf-8") as fin:
+        return fin.read()
+
+
+@pytest.fixture
+def pdf(tmp_path):
+    pdf_path = tmp_path / "doc.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 not really")
+    return str(pdf_path)
+
+
+def test_store_and_restore(tmp_path, pdf):
+    cache = OCRCache(str(tmp_path / "cache"), pdf, "600 png16m -l eng")
+    out_base = str(tmp_path / "page_3")
+    write_page(out_base, "Überschrift\n\f", "<div class='ocr_page'/>")
+    cache.store(3, out_base)
+    os.remove(out_base + ".txt")
+    os.remove(out_base + ".hocr")
+
+    assert not cache.restore(4, out_base)
+    assert cache.restore(3, out_base)
+    assert read(out_base + ".txt") == "Überschrift\n\f"
+    assert read(out_base + ".hocr") == "<div class='ocr_page'/>"
+    assert (cache.hits, cache.stores) == (1, 1)
+
+    # a renamed copy of the same PDF, in a later run, still hits
+    copy = tmp_path / "renamed.pdf"
+    copy.write_bytes((tmp_path / "doc.pdf").read_bytes())
+    assert OCRCache(str(tmp_path / "cache"), str(copy), "600 png16m -l eng").restore(3, str(tmp_path / "again"))
+
+
+def test_settings_keep_entries_apart(tmp_path, pdf):
+    fast = OCRCache(str(tmp_path / "cache"), pdf, "300 pgmraw --oem 1")
+    slow = OCRCache(str(tmp_path / "cache"), pdf, "300 pgmraw --oem 2")
+    out_base = str(tmp_path / "page_1")
+    write_page(out_base, "fast", "<fast/>")
+    fast.store(1, out_base)
+    assert not slow.restore(1, out_base)
+
+    # the page count belongs to the PDF, whatever the settings
+    assert slow.number_of_pages() is None
+    fast.set_number_of_pages(12)
+    assert slow.number_of_pages() == 12
+
+
+def test_text_layer_record(tmp_path, pdf):
+    cache = OCRCache(str(tmp_path / "cache"), pdf, "settings")
+    assert cache.text_layer_pages() is None
+    out_base = str(tmp_path / "page_2")
+    with open(out_base + ".txt", "w", encoding="utf-8") as fout:
+        fout.write("embedded text")
+    cache.store(2, out_base, ("txt",))
+    cache.set_text_layer_pages({2, 10})
+    assert cache.text_layer_pages() == {2, 10}
+    cache.set_text_layer_pages(set())
+    assert cache.text_layer_pages() == set()
+
+    # text layer pages have no hOCR, so they don't pass for OCRed ones
+    os.remove(out_base + ".txt")
+    assert not cache.restore(2, out_base)
+    assert cache.restore(2, out_base, ("txt",))
+    assert read(out_base + ".txt") == "embedded text"
+
+
+def test_unfinished_writes_never_become_entries(tmp_path, pdf, monkeypatch):
+    cache = OCRCache(str(tmp_path / "cache"), pdf, "settings")
+    out_base = str(tmp_path / "page_5")
+    write_page(out_base, "text", "<hocr/>")
+
+    # a job killed halfway through writing a page leaves only its tmp file
+    real_replace = os.replace
+
+    def killed(source, destination):
+        if destination.endswith(".hocr"):
+            raise OSError("killed")
+        real_replace(source, destination)
+    monkeypatch.setattr(os, "replace", killed)
+    with pytest.raises(OSError):
+        cache.store(5, out_base)
+    monkeypatch.setattr(os, "replace", real_replace)
+    assert not path.exists(cache.entry(5, "hocr"))
+    assert not cache.restore(5, str(tmp_path / "restored"))
+
+    # a tmp file cut short is never read as the entry
+    with open(cache.entry(6, "txt") + ".tmp999", "w") as fout:
+        fout.write("xx")
+    assert not cache.restore(6, str(tmp_path / "restored"), ("txt",))
+    with open(path.join(cache.pdf_dir, "pages.tmp999"), "w") as fout:
+        fout.write("1")
+    assert cache.number_of_pages() is None
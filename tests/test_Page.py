@@ -0,0 +1,90 @@
+import random
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from Page import Page
+
+
+HEADERS = ["JOURNAL OF PALEONTOLOGY, VOL. ", "SMITH AND JONES", "Bulletin of the Survey"]
+WORDS = ["the", "shale", "is", "Overlain", "by", "sandstone.", "fossils", "in", "Fig.", ""]
+
+
+def random_page(rng, pageno):
+    lines = []
+    if rng.random() < 0.7:
+        lines.append(rng.choice(HEADERS) + str(pageno))
+    if rng.random() < 0.3:
+        lines.append("")
+    for _ in range(rng.randint(0, 25)):
+        r = rng.random()
+        if r < 0.25:
+            lines.append("")
+        elif r < 0.3:
+            lines.append(" ")
+        elif r < 0.35:
+            lines.append(str(pageno))
+        elif r < 0.4:
+            lines.append(rng.choice(HEADERS))
+        elif r < 0.42:
+            lines.append("None")
+        else:
+            lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 8))))
+    if rng.random() < 0.5:
+        lines.append(str(pageno))
+    return "\n".join(lines)
+
+
+def test_clean_matches_separate_cleanup_passes(tmp_path, fake_document):
+    rng = random.Random(0)
+    for trial in range(300):
+        text = random_page(rng, 10 + trial)
+        page_file = tmp_path / ("page_%d.txt" % trial)
+        page_file.write_text(text, encoding="utf-8")
+        document = fake_document(1, HEADERS + ["Overlain by the"])
+
+        expected = Page(str(page_file), document, 0)
+        expected.expected_page_no = rng.choice([None, 10 + trial])
+        fused = Page(str(page_file), document, 0)
+        fused.expected_page_no = expected.expected_page_no
+
+        expected.cleanup("footer")
+        expected.cleanup("header")
+        expected.cleanup("full_page")
+        expected.remove_empties()
+        fused.clean()
+
+        assert "\n".join(fused.page).encode("utf-8") == "\n".join(expected.page).encode("utf-8"), text
+        assert fused.page == expected.page, text
+
+
+def hocr_page(boxes, height=1000):
+    lines = "".join("<span class='ocr_line' id='line_1_%d' title=\"bbox 100 %d 900 %d; baseline 0 -5\">...</span>\n" % (n, top, bottom)
+                    for n, (top, bottom) in enumerate(boxes))
+    return "<div class='ocr_page' id='page_1' title='image \"page.png\"; bbox 0 0 800 %d; ppageno 0'>\n%s</div>\n" % (height, lines)
+
+
+def test_geometry_mode_finds_footer_in_middle_of_text(tmp_path, fake_document):
+    # two columns: the page number sits under the left one, so in the text
+    # it comes before the whole right column
+    lines = ["SMITH AND JONES", "", "the shale is", "Overlain by", "", "212", "", "sandstone in", "the east", "fossils in", "Fig. 3"]
+    boxes = [(30, 50), (200, 220), (230, 250), (950, 970), (200, 220), (230, 250), (260, 280), (290, 310)]
+    (tmp_path / "page_1.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    (tmp_path / "page_1.hocr").write_text(hocr_page(boxes), encoding="utf-8")
+    document = fake_document(1, ["SMITH AND JONES"])
+
+    text_mode = Page(str(tmp_path / "page_1.txt"), document, 0)
+    assert text_mode.get_firsttwo(True)[1] == [3]
+
+    page = Page(str(tmp_path / "page_1.txt"), document, 0, geometry=True)
+    assert page.get_firsttwo(True) == ([], [212])
+    assert page.get_firsttwo(False) == ([("SMITH AND JONES", 0)], [])
+    page.expected_page_no = 212
+    page.clean()
+    assert "212" not in page.page and "SMITH AND JONES" not in page.page
+    assert page.page[0] == "the shale is"
+
+    # a missing or mismatched hOCR file means the text mode
+    (tmp_path / "page_1.hocr").write_text(hocr_page(boxes[:-1]), encoding="utf-8")
+    fallback = Page(str(tmp_path / "page_1.txt"), document, 0, geometry=True)
+    assert fallback.get_firsttwo(True) == text_mode.get_firsttwo(True)
@@ -0,0 +1,96 @@
+import io
+import random
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import PageTriage
+from PageTriage import read_pnm
+
+
+def test_read_pnm_splits_a_stream_of_pages():
+    p4 = b"P4\n10 2\n" + b"\xff\xc0\x00\x00"  # rows padded to whole bytes, no maxval
+    p5 = b"P5\n# Image generated by Ghostscript\n3 2\n255\n" + bytes(range(6))
+    p5_wide = b"P5 2 1 # a comment between fields\n65535\n" + b"\x01\x02\x03\x04"  # 2 bytes a sample
+    p6 = b"P6\n2 1\n255\n" + bytes(range(6))
+    stream = io.BytesIO(p4 + p5 + p5_wide + p6)
+    assert read_pnm(stream) == p4
+    assert read_pnm(stream) == p5
+    assert read_pnm(stream) == p5_wide
+    assert read_pnm(stream) == p6
+    assert read_pnm(stream) is None
+
+
+def test_read_pnm_returns_none_for_a_truncated_image():
+    assert read_pnm(io.BytesIO(b"P5\n3 2\n255\n" + bytes(5))) is None
+    assert read_pnm(io.BytesIO(b"P5\n3 2")) is None
+    assert read_pnm(io.BytesIO(b"")) is None
+
+
+WIDTH, HEIGHT = 612, 792  # a letter page at TRIAGE_DPI
+
+
+def pgm(pixels, maxval=255):
+    header = b"P5\n# Image generated by Ghostscript\n%d %d\n%d\n" % (pixels.shape[1], pixels.shape[0], maxval)
+    if maxval > 255:
+        return header + pixels.astype(">u2").tobytes()
+    return header + pixels.astype("uint8").tobytes()
+
+
+def paper(numpy):
+    return numpy.full((HEIGHT, WIDTH), 235)
+
+
+def text_page(numpy, rng):
+    pixels = paper(numpy)
+    for top in range(60, HEIGHT - 60, 12):
+        left = 60
+        while left < WIDTH - 100:
+            width = rng.randint(8, 40)
+            pixels[top:top + 7, left:left + width] = rng.randint(20, 90)
+            left += width + 5
+    return pixels
+
+
+def image_page(numpy):
+    pixels = paper(numpy)
+    rows, columns = numpy.mgrid[0:400, 0:450]
+    pixels[100:500, 80:530] = 110 + 80 * numpy.sin(columns / 17.0) * numpy.cos(rows / 23.0)
+    pixels[520:527, 100:300] = 40  # a caption line
+    pixels[740:747, 300:312] = 40  # the page number
+    return pixels
+
+
+def test_triage_page_sorts_blank_image_and_text_pages():
+    numpy = pytest.importorskip("numpy")
+    rng = random.Random(0)
+    blank = paper(numpy)
+    # specks of dust, and a scanner shadow along the edge, inside the margins
+    for _ in range(20):
+        blank[rng.randrange(HEIGHT), rng.randrange(WIDTH)] = 60
+    blank[:, :15] = 30
+    assert PageTriage.triage_page(pgm(blank)) == "blank"
+    assert PageTriage.triage_page(pgm(image_page(numpy))) == "image"
+    assert PageTriage.triage_page(pgm(text_page(numpy, rng))) == "text"
+
+    # text over a figure is still a text page
+    mixed = text_page(numpy, rng)
+    mixed[300:500] = image_page(numpy)[100:300]
+    assert PageTriage.triage_page(pgm(mixed)) == "text"
+
+    # 16-bit samples read the same as 8-bit ones
+    page = text_page(numpy, rng)
+    assert (PageTriage.pnm_pixels(pgm(page * 257, 65535)) == page).all()
+    assert PageTriage.triage_page(pgm(page * 257, 65535)) == "text"
+
+
+def test_ink_components_joins_diagonal_runs():
+    numpy = pytest.importorskip("numpy")
+    ink = numpy.zeros((6, 8), dtype=bool)
+    ink[0, 0:2] = ink[1, 2] = ink[2, 3:5] = True  # one stroke, touching only at corners
+    ink[4:6, 6:8] = True  # a separate 2x2 blob
+    heights, widths, areas = PageTriage.ink_components(ink)
+    assert sorted(zip(heights.tolist(), widths.tolist(), areas.tolist())) == [(2, 2, 4), (3, 5, 5)]
+    assert [len(part) for part in PageTriage.ink_components(numpy.zeros((3, 3), dtype=bool))] == [0, 0, 0]
@@ -0,0 +1,49 @@
+import random
+import sys
+from difflib import SequenceMatcher
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from Similarity import FastEngine, PhraseIndex, SequenceMatcherEngine, lcs_length
+
+
+def random_line(rng, alphabet="aabcde 1.", longest=40):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, longest)))
+
+
+def lcs_table(a, b):
+    row = [0] * (len(b) + 1)
+    for c in a:
+        diagonal, row[0] = 0, 0
+        for j, d in enumerate(b, 1):
+            diagonal, row[j] = row[j], diagonal + 1 if c == d else max(row[j], row[j - 1])
+    return row[-1]
+
+
+def test_fast_engine_agrees_with_sequence_matcher():
+    rng = random.Random(0)
+    reference = SequenceMatcherEngine()
+    engine = FastEngine()
+    for trial in range(1000):
+        a = random_line(rng)
+        # half the pairs are edits of each other, so plenty come near the cutoff
+        b = random_line(rng) if trial % 2 else "".join(c for c in a if rng.random() < 0.8) + random_line(rng, longest=4)
+        assert lcs_length(a, b) == lcs_table(a, b), (a, b)
+        for cutoff in (0.0, 0.5, 0.75, 0.9, 1.0):
+            assert engine.similar(a, b, cutoff) == reference.similar(a, b, cutoff), (a, b, cutoff)
+    assert engine.stats["pruned_length"] and engine.stats["pruned_lcs"] and engine.stats["exact"]
+
+
+def test_phrase_index_agrees_with_sequence_matcher():
+    rng = random.Random(1)
+    for trial in range(80):
+        phrases = set(random_line(rng) for _ in range(rng.randint(0, 12)))
+        index = PhraseIndex(phrases, FastEngine())
+        for _ in range(10):
+            if phrases and rng.random() < 0.5:
+                line = "".join(c for c in rng.choice(sorted(phrases)) if rng.random() < 0.85)
+            else:
+                line = random_line(rng)
+            for cutoff in (0.0, 0.5, 0.75, 0.9):
+                expected = any(SequenceMatcher(None, phrase, line).ratio() > cutoff for phrase in phrases)
+                assert index.matches(line, cutoff) == expected, (sorted(phrases), line, cutoff)
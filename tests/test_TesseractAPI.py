@@ -0,0 +1,40 @@
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import TesseractAPI
+from TesseractAPI import page_separator, parse_args
+
+
+def test_parse_args():
+    assert parse_args("") == ("eng", 3, TesseractAPI.PSM_AUTO, {})
+    assert parse_args("-l eng --psm 1 --oem 2") == ("eng", 2, 1, {})
+    assert parse_args("-l deu+eng --oem 1 -c page_separator= -c tessedit_char_blacklist='|=x'") == \
+        ("deu+eng", 1, TesseractAPI.PSM_AUTO, {"page_separator": "", "tessedit_char_blacklist": "|=x"})
+
+    # anything the API path doesn't handle goes to the binary
+    assert parse_args("-l eng --dpi 300") is None
+    assert parse_args("--tessdata-dir /usr/share -l eng") is None
+    assert parse_args("-l eng hocr") is None
+    # and so does anything malformed
+    assert parse_args("-l") is None
+    assert parse_args("--oem two") is None
+    assert parse_args("-c page_separator") is None
+    assert parse_args("-l 'eng") is None
+
+
+def test_page_separator():
+    # 4 puts page_separator after every page, form feed by default
+    assert page_separator("4.1.1", {}) == "\f"
+    assert page_separator("v4.0.0-beta.1", {"page_separator": "<pb>"}) == "<pb>"
+    # 3 only with include_page_breaks
+    assert page_separator("3.05.01", {}) == ""
+    assert page_separator("3.04", {"include_page_breaks": "0"}) == ""
+    for true in ("1", "true", "T", "yes"):
+        assert page_separator("3.05.01", {"include_page_breaks": true}) == "\f"
+    assert page_separator("3.02", {"include_page_breaks": "1", "page_separator": "##"}) == "##"
+    # 5 only between pages, so never after a single one
+    assert page_separator("5.3.0", {}) == ""
+    assert page_separator("5.0.0", {"page_separator": "<pb>", "include_page_breaks": "1"}) == ""
+    # an unreadable version is taken for 4
+    assert page_separator("", {}) == "\f"
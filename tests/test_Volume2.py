@@ -0,0 +1,130 @@
+import os
+import random
+import sys
+from os import path
+
+import pytest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import Volume2
+from CompactTables import Lexicon
+
+
+RULES = {
+    "romannumerals.txt": "ii\niii\niv\n",
+    "MainDictionary.txt": "the\t1\nshale\t1\nis\t1\nhard\t1\nsoon\t1\nevery\t1\nwhere\t1\nday\t1\nhalf\t1\n"
+                          "way\t1\nmain\t1\nland\t1\nfossils\t1\nabandoned\t1\nüberschrift\t0\nund\t0\n",
+    "PersonalNames.txt": "smith\n",
+    "CorrectionRules.txt": "tlie\tthe\nfoon\tsoon\nevry\tevery\n",
+    "HyphenRules.txt": "sand-stone\tsandstone\nhalf-way\thalf way\n",
+    # every and half begin fuse rules, so what follows them matters
+    "FusingRules.txt": "every where\teverywhere\nhalf way\thalfway\nmain land\tmainland\n",
+    "SyncopeRules.txt": "abandon'd\tabandoned\n",
+}
+
+WORDS = ["the", "The", "tlie", "foon", "shale,", "is", "hard.", "every", "Every", "evry", "where", "day", "half",
+         "way", "Main", "land", "ev", "ery", "sand-", "stone", "half-way", "Smith's", "SMITH", "iii", "1887",
+         "(fossils)", "abandon'd", "Überschrift", "und", "xqzt", "—"]
+
+
+@pytest.fixture
+def rulepath(tmp_path):
+    rules = tmp_path / "rules"
+    rules.mkdir()
+    for name, text in RULES.items():
+        (rules / name).write_text(text, encoding="utf-8")
+    return str(rules)
+
+
+def random_pages(rng, n_pages):
+    pages = []
+    for _ in range(n_pages):
+        lines = []
+        for _ in range(rng.randint(0, 12)):
+            if rng.random() < 0.1:
+                lines.append("\n")
+            else:
+                lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 10))) + "\n")
+        pages.append(lines)
+    return pages
+
+
+def stream(corrector, pages):
+    tokens = []
+    for lines in pages:
+        tokens.extend(corrector.as_stream(lines)[0])
+        tokens.append("<pb>")
+    return tokens
+
+
+def test_memo_size_does_not_change_corrections(rulepath):
+    pages = random_pages(random.Random(0), 40)
+    results = []
+    for memo_size in (0, Volume2.MEMO_SIZE, 3):
+        corrector = Volume2.Corrector.from_rulepath(rulepath, memo_size=memo_size)
+        tokens = stream(corrector, pages)
+        # a second run over the same tokens is mostly memo hits, or evictions
+        first = corrector.correct_stream(tokens)
+        assert corrector.correct_stream(tokens) == first
+        results.append(first)
+        if memo_size == 0:
+            assert len(corrector.memo) == 0
+        elif memo_size == 3:
+            assert corrector.memo.stats["evicted"] > 0
+        else:
+            assert corrector.memo.stats["hits"] > 0 and corrector.memo.stats["evicted"] == 0
+    assert results[0] == results[1] == results[2]
+
+    # the fused pairs and the fuse rule first words left alone are both there
+    corrected = results[0][0]
+    assert "everywhere" in corrected and "halfway" in corrected and "Mainland" in corrected
+    assert "every" in corrected and "half" in corrected
+
+
+def corrections(corrector, pages):
+    return [corrector.as_stream(lines) for lines in pages], corrector.correct_stream(stream(corrector, pages))
+
+
+def test_shared_rules_correct_like_loaded_ones(tmp_path, rulepath):
+    pages = random_pages(random.Random(1), 20)
+    expected = corrections(Volume2.Corrector.from_rulepath(rulepath), pages)
+    compiled = str(tmp_path / "compiled")
+    for shared in (False, True, False, True):
+        # compiled on the first call, loaded or mapped from the snapshot after
+        corrector = Volume2.Corrector.from_rulepath(rulepath, shared, compiled_dir=compiled)
+        assert isinstance(corrector.lexicon, Lexicon) == shared
+        assert corrections(corrector, pages) == expected
+    assert path.exists(path.join(compiled, Volume2.COMPILED))
+
+    # without a snapshot directory, shared tables are built in memory
+    corrector = Volume2.Corrector.from_rulepath(rulepath, True)
+    assert isinstance(corrector.lexicon, Lexicon)
+    assert corrections(corrector, pages) == expected
+    assert sorted(os.listdir(rulepath)) == sorted(RULES)
+
+    # nowhere to write the snapshot falls back on the same in-memory tables
+    (tmp_path / "file").write_text("", encoding="utf-8")
+    corrector = Volume2.Corrector.from_rulepath(rulepath, True, compiled_dir=str(tmp_path / "file" / "compiled"))
+    assert isinstance(corrector.lexicon, Lexicon)
+    assert corrections(corrector, pages) == expected
+
+
+def test_changed_rule_file_forces_recompile(tmp_path, rulepath):
+    compiled = str(tmp_path / "compiled")
+    Volume2.Corrector.from_rulepath(rulepath, True, compiled_dir=compiled)
+    assert Volume2.load_compiled(rulepath, compiled_dir=compiled) is not None
+
+    # touching a rule file is enough to make the snapshot stale
+    dictionary = path.join(rulepath, "MainDictionary.txt")
+    info = os.stat(dictionary)
+    os.utime(dictionary, ns=(info.st_atime_ns, info.st_mtime_ns + 10 ** 9))
+    assert Volume2.load_compiled(rulepath, compiled_dir=compiled) is None
+    Volume2.Corrector.from_rulepath(rulepath, True, compiled_dir=compiled)
+    assert Volume2.load_compiled(rulepath, compiled_dir=compiled) is not None
+
+    # and a changed one is picked up, shared or not
+    with open(dictionary, "a", encoding="utf-8") as fout:
+        fout.write("quartz\t1\n")
+    for shared in (True, False):
+        corrector = Volume2.Corrector.from_rulepath(rulepath, shared, compiled_dir=compiled)
+        assert corrector.is_word("quartz")